@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from telegram import ReplyKeyboardMarkup, Update
-from telegram.ext import Application, MessageHandler, ContextTypes, filters
+from telegram.ext import ContextTypes
 from telegram.constants import ParseMode
 import random
 
@@ -253,12 +253,13 @@ async def handle_trevoha(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         reply_markup=ANXIETY_FLOW_KB
     )
 
-# Роутер на текстовые кнопки блока
-def setup_anxiety_block(app: Application) -> None:
+# Текстовые кнопки блока (подключаются в MenuRouter)
+ANXIETY_MENU = {
     # Главное подменю «Мне тяжело»
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex(r"^Мне тяжело$"), menu_me_tiazhelo))
+    "Мне тяжело": menu_me_tiazhelo,
     # Подкатегория «Тревога»
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex(r"^Тревога$"), handle_trevoha))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex(r"^Ещё по тревоге$"), handle_trevoha))
+    "Тревога": handle_trevoha,
+    "Ещё по тревоге": handle_trevoha,
     # Назад
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex(r"^Назад$"), handle_back))
+    "Назад": handle_back,
+}
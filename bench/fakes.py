@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import itertools
+import math
+import random
+import time
+from types import SimpleNamespace
+from telegram import Update
+
+# --- Заглушки OpenAI и Telegram для нагрузочного прогона без сети ---
+
+
+# Задержка до первого токена — логнормальная: медиана median_ms, «хвост» задаёт sigma
+class LatencyModel:
+    def __init__(self, median_ms: float = 300, sigma: float = 0.5, tokens_per_sec: float = 300,
+                 reply_tokens: int = 120, seed: int = None):
+        self.median = median_ms / 1000
+        self.sigma = sigma
+        self.tokens_per_sec = tokens_per_sec
+        self.reply_tokens = reply_tokens
+        self.rng = random.Random(seed)
+
+    def first_token(self) -> float:
+        return self.median * math.exp(self.rng.gauss(0, self.sigma)) if self.sigma else self.median
+
+    def tokens(self) -> int:
+        return max(1, int(self.rng.gauss(self.reply_tokens, self.reply_tokens * 0.25)))
+
+
+REPLY_WORDS = ("Понимаю тебя. Это правда непросто, и то, что ты это чувствуешь, — нормально. "
+               "Давай попробуем разобраться вместе, шаг за шагом. ").split()
+
+
+def _usage(prompt_tokens, completion_tokens, cached_tokens):
+    return SimpleNamespace(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+        prompt_tokens_details=SimpleNamespace(cached_tokens=cached_tokens),
+    )
+
+
+def _prompt_tokens(messages):
+    return sum(len(m.get("content") or "") for m in messages) // 3
+
+
+class FakeStream:
+    def __init__(self, model: LatencyModel, tokens: int, prompt_tokens: int):
+        self.model = model
+        self.tokens = tokens
+        self.prompt_tokens = prompt_tokens
+        self.closed = False
+
+    async def _gen(self):
+        words = itertools.cycle(REPLY_WORDS)
+        step = 1 / self.model.tokens_per_sec if self.model.tokens_per_sec else 0
+        # по несколько токенов за чанк, как у настоящего API под нагрузкой
+        for _ in range(0, self.tokens, 4):
+            if self.closed:
+                return
+            await asyncio.sleep(step * 4)
+            delta = SimpleNamespace(content=" ".join(next(words) for _ in range(3)) + " ")
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=None)
+        yield SimpleNamespace(choices=[], usage=_usage(self.prompt_tokens, self.tokens, self.prompt_tokens // 2))
+
+    def __aiter__(self):
+        return self._gen()
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeCompletions:
+    def __init__(self, owner):
+        self.owner = owner
+
+    async def create(self, model=None, messages=(), stream=False, **kwargs):
+        owner = self.owner
+        owner.calls += 1
+        owner.models[model] = owner.models.get(model, 0) + 1
+        await asyncio.sleep(owner.latency.first_token())
+        if owner.error_rate and owner.latency.rng.random() < owner.error_rate:
+            raise asyncio.TimeoutError()
+        tokens = owner.latency.tokens()
+        prompt_tokens = _prompt_tokens(messages)
+        if stream:
+            return FakeStream(owner.latency, tokens, prompt_tokens)
+        if owner.latency.tokens_per_sec:
+            await asyncio.sleep(tokens / owner.latency.tokens_per_sec)
+        words = itertools.cycle(REPLY_WORDS)
+        text = " ".join(next(words) for _ in range(max(1, tokens * 3 // 4)))
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=text))],
+            usage=_usage(prompt_tokens, tokens, prompt_tokens // 2),
+        )
+
+
+class FakeTranscriptions:
+    def __init__(self, owner):
+        self.owner = owner
+
+    async def create(self, model=None, file=None, **kwargs):
+        self.owner.calls += 1
+        await asyncio.sleep(self.owner.latency.first_token())
+        return SimpleNamespace(text="Мне сегодня очень тревожно, не могу успокоиться")
+
+
+# Повторяет ту часть AsyncOpenAI, которой пользуется бот
+class FakeOpenAI:
+    def __init__(self, latency: LatencyModel = None, error_rate: float = 0.0):
+        self.latency = latency or LatencyModel()
+        self.error_rate = error_rate
+        self.calls = 0
+        self.models = {}
+        self.chat = SimpleNamespace(completions=FakeCompletions(self))
+        self.audio = SimpleNamespace(transcriptions=FakeTranscriptions(self))
+
+    def with_options(self, **kwargs):
+        return self
+
+
+# --- Telegram ---
+# Бот записывает вызовы и отвечает с задержкой api_ms, как Bot API
+class FakeFile:
+    async def download_to_memory(self, out):
+        out.write(b"OggS" + b"\0" * 4096)
+
+
+class FakeBot:
+    def __init__(self, api_ms: float = 30):
+        self.api_delay = api_ms / 1000
+        self.calls = {}
+        self._ids = itertools.count(1000)
+        self.username = "bench_bot"
+
+    async def _call(self, method, chat_id=None, text=None):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        await asyncio.sleep(self.api_delay)
+        return SimpleNamespace(message_id=next(self._ids), chat_id=chat_id, text=text)
+
+    async def send_message(self, chat_id, text, *args, **kwargs):
+        return await self._call("send_message", chat_id, text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        return await self._call("edit_message_text", chat_id, text)
+
+    async def send_chat_action(self, chat_id, action, **kwargs):
+        return await self._call("send_chat_action", chat_id)
+
+    async def get_file(self, file_id, **kwargs):
+        await self._call("get_file")
+        return FakeFile()
+
+
+class FakeApplication:
+    def __init__(self, bot):
+        self.bot = bot
+        self.tasks = set()
+
+    def create_task(self, coro, update=None):
+        task = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def wait_background(self):
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks), return_exceptions=True)
+
+
+class FakeContext:
+    def __init__(self, application):
+        self.application = application
+        self.bot = application.bot
+
+
+# Настоящие объекты Update, привязанные к FakeBot: reply_text идёт в FakeBot.send_message
+class UpdateFactory:
+    def __init__(self, bot):
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _message(self, user_id, **fields):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            **fields,
+        }
+
+    def text(self, user_id, text):
+        return Update.de_json({"update_id": next(self._update_ids), "message": self._message(user_id, text=text)}, self.bot)
+
+    def voice(self, user_id, duration=10):
+        voice = {"file_id": f"voice{user_id}", "file_unique_id": f"u{user_id}", "duration": duration}
+        return Update.de_json({"update_id": next(self._update_ids), "message": self._message(user_id, voice=voice)}, self.bot)
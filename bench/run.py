@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+# --- Нагрузочный прогон handle_message без Telegram и OpenAI ---
+# Настоящие обработчики main.py + временная база + заглушки из fakes.py.
+#
+#   python bench/run.py --users 1000 --turns 5
+#   python bench/run.py --save bench/baseline.json      # записать базовую линию
+#   python bench/run.py --compare bench/baseline.json   # сравнить с ней
+#   python bench/run.py --conversations talks.jsonl     # записанные диалоги:
+#       одна строка — {"user_id": 1, "messages": ["...", "..."]} или просто ["...", "..."]
+#
+# Отчёт: задержка хода p50/p95/p99, сообщений в секунду, SQL-запросов и
+# коммитов на ход, пиковая память процесса.
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fakes import FakeApplication, FakeBot, FakeContext, FakeOpenAI, LatencyModel, UpdateFactory
+
+SYNTHETIC = [
+    "Привет",
+    "Мне сегодня очень тревожно, не могу уснуть",
+    "Он не пишет уже три дня, что мне делать?",
+    "Бывший снова написал мне, ответить ему или нет?",
+    "Распиши подробно, как перестать накручивать себя",
+    "Что ему ответить, чтобы не выглядеть навязчивой?",
+    "Я чувствую себя одинокой по вечерам",
+    "Спасибо, мне стало немного легче",
+    "Не понимаю, объясни по-другому",
+    "Мама опять кричит на меня из-за денег",
+    "На работе всё валится из рук",
+    "Как пережить расставание?",
+]
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def load_conversations(path):
+    conversations = []
+    with open(path, encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if isinstance(item, list):
+                item = {"user_id": 10_000_000 + i, "messages": item}
+            conversations.append((item["user_id"], item["messages"]))
+    return conversations
+
+
+def synthetic_conversations(users, turns, seed):
+    rng = random.Random(seed)
+    return [(10_000_000 + u, [rng.choice(SYNTHETIC) for _ in range(turns)]) for u in range(users)]
+
+
+def import_main(args, db_path):
+    # Конфиг main.py читается при импорте — задаём его до импорта
+    os.environ.update({
+        "TELEGRAM_TOKEN": "0:bench",
+        "OPENAI_API_KEY": "bench",
+        "DB_PATH": db_path,
+        "STREAM_REPLIES": "1" if args.stream else "0",
+        "OPENAI_RPM": str(args.rpm),
+        "LLM_MAX_CONCURRENCY": str(args.llm_concurrency),
+        "LLM_MAX_QUEUE": str(max(200, args.users * 2)),
+        "RATE_SUBSCRIBER_PER_MIN": "100000",
+        "RATE_FREE_PER_MIN": "100000",
+        "RATE_SOFT_LIMIT_PER_MIN": "100000",
+        "STREAM_EDIT_INTERVAL": str(args.edit_interval),
+    })
+    os.environ.pop("WEBHOOK_SECRET", None)
+    import main
+    return main
+
+
+def subscribe_users(conn, user_ids, share, seed):
+    rng = random.Random(seed)
+    now = datetime.datetime.now()
+    rows = [(uid, now, now, now + datetime.timedelta(days=30), now, now)
+            for uid in user_ids if rng.random() < share]
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (user_id, first_message_time, last_message_time, subscription_end, "
+            "last_voice_reset, last_daily_reset) VALUES (?, ?, ?, ?, ?, ?)", rows
+        )
+    return len(rows)
+
+
+async def drive(main, conversations, args):
+    fake_openai = FakeOpenAI(
+        LatencyModel(args.llm_ms, args.llm_sigma, args.tokens_per_sec, args.reply_tokens, args.seed),
+        error_rate=args.error_rate,
+    )
+    main.client = fake_openai
+    main.completions.client = fake_openai
+    bot = FakeBot(api_ms=args.telegram_ms)
+    app = FakeApplication(bot)
+    context = FakeContext(app)
+    updates = UpdateFactory(bot)
+
+    statements = []
+    main.db.run_sync(lambda conn: conn.set_trace_callback(statements.append))
+    main.message_log.start()
+
+    # Как PTB с concurrent_updates: не больше N апдейтов одновременно,
+    # апдейты одного пользователя — строго по очереди (каждый диалог — одна корутина)
+    gate = asyncio.Semaphore(args.concurrency)
+    latencies = []
+
+    async def user(user_id, messages):
+        for i, text in enumerate(messages):
+            update = updates.voice(user_id) if args.voice_share and random.random() < args.voice_share \
+                else updates.text(user_id, text)
+            async with gate:
+                started = time.perf_counter()
+                await main.handle_message(update, context)
+                latencies.append(time.perf_counter() - started)
+            if args.think_ms:
+                await asyncio.sleep(args.think_ms / 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(uid, msgs) for uid, msgs in conversations))
+    wall = time.perf_counter() - started
+    await app.wait_background()
+    await main.message_log.stop()
+    main.db.run_sync(lambda conn: conn.set_trace_callback(None))
+
+    turns = len(latencies)
+    commits = sum(1 for s in statements if s.strip().upper().startswith("COMMIT"))
+    queries = sum(1 for s in statements if not s.strip().upper().startswith(("BEGIN", "COMMIT")))
+    return {
+        "users": len(conversations),
+        "turns": turns,
+        "wall_s": round(wall, 2),
+        "msgs_per_sec": round(turns / wall, 1) if wall else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "sql_per_turn": round(queries / turns, 2) if turns else 0.0,
+        "commits_per_turn": round(commits / turns, 2) if turns else 0.0,
+        "llm_calls": fake_openai.calls,
+        "telegram_calls": sum(bot.calls.values()),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+# Чем больше — тем лучше только msgs_per_sec, остальное — чем меньше, тем лучше
+HIGHER_IS_BETTER = {"msgs_per_sec"}
+COMPARED = ("msgs_per_sec", "p50_ms", "p95_ms", "p99_ms", "sql_per_turn", "commits_per_turn", "peak_rss_mb")
+
+
+def print_report(result, baseline=None):
+    for key, value in result.items():
+        line = f"{key:>18}: {value}"
+        if baseline and key in COMPARED and baseline.get(key):
+            delta = (value - baseline[key]) / baseline[key] * 100
+            better = (delta > 0) == (key in HIGHER_IS_BETTER)
+            line += f"   ({delta:+.1f}% vs {baseline[key]}{'' if abs(delta) < 1 else ' ✓' if better else ' ✗'})"
+        print(line)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота на заглушках")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--turns", type=int, default=4)
+    parser.add_argument("--conversations", help="JSONL с записанными диалогами")
+    parser.add_argument("--concurrency", type=int, default=64, help="апдейтов одновременно (как UPDATE_CONCURRENCY)")
+    parser.add_argument("--llm-concurrency", type=int, default=64)
+    parser.add_argument("--rpm", type=float, default=0, help="квота OpenAI в минуту (0 — без ограничения)")
+    parser.add_argument("--llm-ms", type=float, default=300, help="медиана задержки до первого токена")
+    parser.add_argument("--llm-sigma", type=float, default=0.5, help="разброс задержки (логнормальный)")
+    parser.add_argument("--tokens-per-sec", type=float, default=300)
+    parser.add_argument("--reply-tokens", type=int, default=120)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля запросов к модели с таймаутом")
+    parser.add_argument("--telegram-ms", type=float, default=30, help="задержка ответа Bot API")
+    parser.add_argument("--think-ms", type=float, default=0, help="пауза пользователя между сообщениями")
+    parser.add_argument("--voice-share", type=float, default=0.0)
+    parser.add_argument("--subscribed", type=float, default=0.5, help="доля пользователей с подпиской")
+    parser.add_argument("--edit-interval", type=float, default=1.0)
+    parser.add_argument("--no-stream", dest="stream", action="store_false")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db", help="путь к базе (по умолчанию — временный файл)")
+    parser.add_argument("--save", help="сохранить результат в JSON")
+    parser.add_argument("--compare", help="сравнить с сохранённым JSON")
+    parser.add_argument("--json", action="store_true", help="вывести результат одной строкой JSON")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    tmp = None
+    if args.db:
+        db_path = args.db
+    else:
+        tmp = tempfile.TemporaryDirectory(prefix="bot_bench_")
+        db_path = os.path.join(tmp.name, "bot_memory.db")
+
+    conversations = load_conversations(args.conversations) if args.conversations \
+        else synthetic_conversations(args.users, args.turns, args.seed)
+    main = import_main(args, db_path)
+    try:
+        main.db.run_sync(subscribe_users, [uid for uid, _ in conversations], args.subscribed, args.seed)
+        result = asyncio.run(drive(main, conversations, args))
+    finally:
+        main.db.close()
+        if tmp is not None:
+            tmp.cleanup()
+
+    result["config"] = {k: v for k, v in vars(args).items() if k not in ("save", "compare", "json", "db")}
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False))
+    else:
+        baseline = None
+        if args.compare:
+            with open(args.compare, encoding="utf-8") as f:
+                baseline = json.load(f)
+        print_report({k: v for k, v in result.items() if k != "config"}, baseline)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
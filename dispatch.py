@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from contextlib import asynccontextmanager
+from telegram.ext import Application
+
+
+# --- Замки по пользователям ---
+# Запись создаётся при первом апдейте пользователя и удаляется, как только
+# его апдейты закончились, — память зависит только от числа активных сейчас.
+# asyncio.Lock будит ожидающих по очереди, так что порядок апдейтов сохраняется.
+class UserLocks:
+    def __init__(self):
+        self._locks = {}  # key -> [asyncio.Lock, сколько апдейтов держат/ждут]
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
+
+
+def update_key(update):
+    if getattr(update, "effective_user", None) is not None:
+        return update.effective_user.id
+    if getattr(update, "effective_chat", None) is not None:
+        return update.effective_chat.id
+    return None
+
+
+# Собственный лимит PTB (concurrent_updates) берётся ещё до process_update, то есть
+# до замка пользователя: апдейт, ждущий своей очереди, занимал бы общий слот, и
+# один пользователь с пачкой сообщений забирал бы все слоты. Поэтому лимит PTB
+# выставляется заведомо недостижимым, а настоящий держит update_slots.
+PTB_UNBOUNDED = 2 ** 31 - 1
+
+
+# --- Application: разные пользователи параллельно, один пользователь — строго по очереди ---
+# Включается через per_user_builder(). Сначала апдейт ждёт своей очереди у
+# пользователя (слот не занят), и только когда подошла его очередь — общий слот
+# из max_concurrent. Замок берётся на весь process_update, поэтому покрывает все
+# хендлеры, включая подключённые блоками.
+class PerUserApplication(Application):
+    __slots__ = ("user_locks", "update_slots")
+
+    def __init__(self, max_concurrent: int = 64, **kwargs):
+        super().__init__(**kwargs)
+        self.user_locks = UserLocks()
+        self.update_slots = asyncio.Semaphore(max_concurrent)
+
+    async def process_update(self, update):
+        key = update_key(update)
+        if key is None:
+            async with self.update_slots:
+                return await super().process_update(update)
+        async with self.user_locks.hold(key):
+            async with self.update_slots:
+                return await super().process_update(update)
+
+
+def per_user_builder(builder, max_concurrent: int):
+    return builder.application_class(
+        PerUserApplication, kwargs={"max_concurrent": max_concurrent}
+    ).concurrent_updates(PTB_UNBOUNDED)
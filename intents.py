@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import json
+import re
+from dataclasses import dataclass
+
+# --- Ключевые слова по группам (можно дополнить файлом INTENT_KEYWORDS_FILE) ---
+DEFAULT_KEYWORDS = {
+    # Явная просьба ответить подробно
+    "detailed_explicit": [
+        "подробно", "развёрнуто", "развернуто", "с разбором",
+        "глубокий анализ", "проанализируй", "проанализировать",
+        "распиши", "пошагово", "с примерами", "подробный разбор",
+    ],
+    # Сложный запрос — развёрнутый ответ и без явной просьбы
+    "detailed_auto": [
+        "почему", "объясни", "объяснишь", "анал", "разбор",
+        "что делать", "как поступить", "как быть",
+        "стоит ли", "нужно ли", "правильно ли", "это манипуляция",
+        "газлайт", "абьюз", "нарцис",
+    ],
+    # Нужны готовые варианты фраз
+    "variants": [
+        "что ответить", "как ответить", "смс", "сообщение",
+        "написал", "написала", "переписка", "что сказать",
+        "здороваться", "не здороваться", "встреча",
+        "позвонить", "не звонить",
+    ],
+    # Тема бывшего/возврата
+    "ex_topic": [
+        "бывш", "экс", "вернуть", "no contact", "но контакт", "игнор",
+        "не писать", "тоска", "скучает", "вернется", "вернулся", "вернулась",
+        "помириться", "сойтись", "расставание", "разошлись",
+    ],
+    # Просьба переформулировать (ищем в недавних сообщениях пользователя)
+    "reformulate": ["не подходит", "иначе", "по-другому", "не то", "распиши"],
+}
+
+LONG_TEXT = 600  # символов — длинный текст сам по себе повод для развёрнутого ответа
+
+
+@dataclass(frozen=True, slots=True)
+class Intent:
+    detailed_explicit: bool
+    detailed_auto: bool   # без учёта истории — её смотрит IntentMatcher.reformulating()
+    variants: bool
+    ex_topic: bool
+
+
+# Регулярка в виде префиксного дерева: общие начала слов не проверяются повторно,
+# так что стоимость прохода зависит от длины текста, а не от числа ключей.
+def _trie_pattern(words):
+    trie = {}
+    for w in words:
+        node = trie
+        for ch in w:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    def build(node):
+        end = node.get("", False)
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if end:
+            # ключ — префикс более длинного: длинный пробуем первым (жадно)
+            return "(?:" + body + ")?"
+        return body
+
+    return build(trie)
+
+
+# --- Классификатор намерений: один проход по тексту на все группы ---
+# Ищем совпадение, начинающееся в каждой позиции (lookahead), — как и прежние
+# проверки `k in text.lower()`. Текст переводится в нижний регистр один раз, а
+# регулярка — без IGNORECASE: иначе совпадали бы символы, которые только
+# «складываются» в букву ключа (например, ᲀ — в «в»), а .lower() их в неё не переводит. Ключ несёт группы всех ключей, которые в нём содержатся,
+# поэтому найденный длинный ключ не прячет вложенные в него короткие.
+class IntentMatcher:
+    def __init__(self, keywords: dict):
+        self.groups = list(keywords)
+        bits = {g: 1 << i for i, g in enumerate(self.groups)}
+        own = {}
+        for group, words in keywords.items():
+            for w in words:
+                w = w.lower()
+                own[w] = own.get(w, 0) | bits[group]
+        self._masks = {
+            w: mask_or(own[k] for k in own if k in w) for w in own
+        }
+        self._bits = bits
+        self._regex = re.compile("(?=(" + _trie_pattern(own) + "))")
+
+    def scan(self, text: str) -> int:
+        mask = 0
+        masks = self._masks
+        for m in self._regex.finditer(text.lower()):
+            mask |= masks[m.group(1)]
+        return mask
+
+    def has(self, mask: int, group: str) -> bool:
+        return bool(mask & self._bits[group])
+
+    def classify(self, text: str) -> Intent:
+        if not text:
+            return Intent(False, False, False, False)
+        mask = self.scan(text)
+        detailed_auto = (
+            len(text) > LONG_TEXT
+            or text.count("?") >= 2
+            or self.has(mask, "detailed_auto")
+        )
+        return Intent(
+            detailed_explicit=self.has(mask, "detailed_explicit"),
+            detailed_auto=detailed_auto,
+            variants=self.has(mask, "variants"),
+            ex_topic=self.has(mask, "ex_topic"),
+        )
+
+    # Пользователь недавно просил ответить иначе — тоже повод для развёрнутого ответа
+    def reformulating(self, history: list) -> bool:
+        bit = self._bits["reformulate"]
+        return any(
+            self.scan(m["content"]) & bit
+            for m in history[-6:] if m["role"] == "user"
+        )
+
+
+def mask_or(values):
+    mask = 0
+    for v in values:
+        mask |= v
+    return mask
+
+
+def load_matcher(path=None) -> IntentMatcher:
+    keywords = {group: list(words) for group, words in DEFAULT_KEYWORDS.items()}
+    if path:
+        with open(path, encoding="utf-8") as f:
+            extra = json.load(f)
+        for group, words in extra.items():
+            keywords.setdefault(group, []).extend(words)
+    return IntentMatcher(keywords)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import glob
+import os
+import re
+import numpy as np
+from tokens import count_message_tokens
+
+SECTION_RE = re.compile(r"^\[(.+?)\]\s*$", re.MULTILINE)
+WORD_RE = re.compile(r"\w+")
+STEM_LEN = 5  # грубый стемминг: «бывшего», «бывший», «бывшим» → «бывши»
+
+
+def split_sections(text: str, source: str):
+    # Справочник разбит на блоки вида «[Заголовок]\nтекст…»
+    sections = []
+    matches = list(SECTION_RE.finditer(text))
+    for i, m in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        body = text[m.start():end].strip()
+        if body:
+            sections.append((source, m.group(1).strip(), body))
+    return sections
+
+
+def tokenize(text: str):
+    return [w[:STEM_LEN] for w in WORD_RE.findall(text.lower()) if len(w) > 2]
+
+
+# --- Поиск по справочникам: BM25 по разделам ---
+# Индекс строится один раз при запуске: матрица весов BM25 (разделы × термы),
+# так что запрос — это сумма нескольких столбцов и выбор top-k.
+class KnowledgeBase:
+    def __init__(self, sections, k1: float = 1.5, b: float = 0.75):
+        self.sections = sections
+        self.texts = [body for _, _, body in sections]
+        self.tokens = np.array([count_message_tokens(t) for t in self.texts], dtype=np.int32)
+        self.vocab = {}
+        docs = [tokenize(t) for t in self.texts]
+        for doc in docs:
+            for term in doc:
+                self.vocab.setdefault(term, len(self.vocab))
+        tf = np.zeros((len(docs), len(self.vocab)), dtype=np.float32)
+        for i, doc in enumerate(docs):
+            for term in doc:
+                tf[i, self.vocab[term]] += 1
+        if len(docs):
+            df = (tf > 0).sum(axis=0)
+            idf = np.log(1 + (len(docs) - df + 0.5) / (df + 0.5)).astype(np.float32)
+            lengths = tf.sum(axis=1, keepdims=True)
+            norm = k1 * (1 - b + b * lengths / max(float(lengths.mean()), 1.0))
+            self.weights = idf * tf * (k1 + 1) / (tf + norm)
+        else:
+            self.weights = tf
+
+    def __len__(self):
+        return len(self.sections)
+
+    def search(self, query: str, top_k: int = 2, min_score: float = 0.0):
+        cols = sorted({self.vocab[t] for t in tokenize(query) if t in self.vocab})
+        if not cols or not len(self.sections):
+            return []
+        scores = self.weights[:, cols].sum(axis=1)
+        best = np.argsort(-scores)[:top_k]
+        return [int(i) for i in best if scores[i] > min_score]
+
+    def render(self, ids) -> str:
+        return "\n\n".join(self.texts[i] for i in ids)
+
+    def tokens_for(self, ids) -> int:
+        return int(self.tokens[ids].sum()) if len(ids) else 0
+
+
+# Встроенные справочники + все *.txt из kb_dir (тот же формат с [разделами])
+def build_knowledge_base(builtin: dict, kb_dir=None) -> KnowledgeBase:
+    sections = []
+    for source, text in builtin.items():
+        sections.extend(split_sections(text, source))
+    if kb_dir and os.path.isdir(kb_dir):
+        for path in sorted(glob.glob(os.path.join(kb_dir, "*.txt"))):
+            with open(path, encoding="utf-8") as f:
+                sections.extend(split_sections(f.read(), os.path.basename(path)))
+    return KnowledgeBase(sections)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from rate_limit import TokenBucket
+
+# Приоритеты очереди: меньше — раньше
+PRIORITY_SUBSCRIBER = 0
+PRIORITY_FREE = 1
+PRIORITY_SOFT_LIMIT = 2
+PRIORITY_BACKGROUND = 3  # резюме и прочая фоновая работа
+
+
+class LLMQueueFull(Exception):
+    pass
+
+
+# --- Ограничитель параллельных запросов к LLM с очередью ---
+# Не больше max_concurrency запросов одновременно и не чаще rate_per_minute
+# (квота OpenAI), остальные ждут в очереди с приоритетом: при перегрузке
+# подписчики идут раньше бесплатных. Внутри одного приоритета — FIFO.
+# Освободившийся слот передаётся следующему ожидающему напрямую, без гонки.
+class LLMScheduler:
+    def __init__(self, max_concurrency: int = 8, max_queue: int = 200, rate_per_minute: float = 0):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max_queue
+        self.bucket = TokenBucket(rate_per_minute / 60.0, max(1.0, rate_per_minute / 60.0)) if rate_per_minute else None
+        self._waiters = []  # куча (priority, seq, future)
+        self._seq = itertools.count()
+        self._timer = None
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def _rate_wait(self) -> float:
+        return self.bucket.wait_time() if self.bucket else 0.0
+
+    def _take_rate_token(self):
+        if self.bucket:
+            self.bucket.try_take()
+
+    # Таймер ожидания токена квоты: сбрасываем его только здесь, когда он сработал.
+    # Пока таймер взведён, _grant() из _acquire/_release второй не ставит.
+    def _on_timer(self):
+        self._timer = None
+        self._grant()
+
+    # Раздаём слоты ожидающим, пока есть и слот, и токен квоты
+    def _grant(self):
+        while self._waiters and self.in_flight < self.max_concurrency:
+            wait = self._rate_wait()
+            if wait > 0:
+                if self._timer is None:
+                    self._timer = asyncio.get_running_loop().call_later(wait, self._on_timer)
+                return
+            _, _, fut = heapq.heappop(self._waiters)
+            if fut.done():
+                continue
+            self._take_rate_token()
+            self.in_flight += 1
+            fut.set_result(None)
+
+    async def _acquire(self, priority):
+        if not self._waiters and self.in_flight < self.max_concurrency and self._rate_wait() == 0:
+            self._take_rate_token()
+            self.in_flight += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise LLMQueueFull(f"очередь LLM переполнена ({len(self._waiters)})")
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        self._grant()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # Слот уже передали нам — возвращаем его следующему
+                self._release()
+            else:
+                self._waiters = [w for w in self._waiters if w[2] is not fut]
+                heapq.heapify(self._waiters)
+            raise
+
+    def _release(self):
+        self.in_flight -= 1
+        self._grant()
+
+    # Слот держится весь блок — нужно для стриминга, где ответ дочитывается после create()
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_FREE):
+        enqueued = time.monotonic()
+        await self._acquire(priority)
+        waited = time.monotonic() - enqueued
+        self.last_wait = waited
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        try:
+            yield
+        finally:
+            self.completed += 1
+            self._release()
+
+    async def submit(self, call, *args, priority: int = PRIORITY_FREE, **kwargs):
+        async with self.slot(priority):
+            return await call(*args, **kwargs)
+
+    def stats(self) -> dict:
+        done = self.completed or 1
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "max_concurrency": self.max_concurrency,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.total_wait / done * 1000, 1),
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            "last_wait_ms": round(self.last_wait * 1000, 1),
+        }
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from telegram import ReplyKeyboardMarkup, Update
-from telegram.ext import Application, MessageHandler, ContextTypes, filters
+from telegram.ext import ContextTypes
 from telegram.constants import ParseMode
 import random
 
@@ -217,7 +217,8 @@ async def handle_lonely(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         reply_markup=LONELY_FLOW_KB
     )
 
-def setup_loneliness_block(app: Application) -> None:
-    # Обработчики для кнопок «Одиночество» и «Ещё про одиночество»
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex(r"^Одиночество$"), handle_lonely))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex(r"^Ещё про одиночество$"), handle_lonely))
+# Кнопки «Одиночество» и «Ещё про одиночество» (подключаются в MenuRouter)
+LONELY_MENU = {
+    "Одиночество": handle_lonely,
+    "Ещё про одиночество": handle_lonely,
+}
@@ -1,16 +1,43 @@
 import os
-import sqlite3
+import io
 import datetime
+import math
 import time
 import random
 import asyncio
+import signal
 from dotenv import load_dotenv
 from telegram import Update, ReplyKeyboardMarkup
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
-from openai import OpenAI
-from anxiety_block import setup_anxiety_block, MAIN_MENU_KB
-from tears_block import setup_tears_block
-from loneliness_block import setup_loneliness_block
+from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
+from telegram.request import HTTPXRequest
+from openai import AsyncOpenAI
+from anxiety_block import ANXIETY_MENU, MAIN_MENU_KB
+from tears_block import TEARS_MENU
+from loneliness_block import LONELY_MENU
+from menu import MenuRouter
+from llm_scheduler import (
+    LLMScheduler, LLMQueueFull,
+    PRIORITY_SUBSCRIBER, PRIORITY_FREE, PRIORITY_SOFT_LIMIT, PRIORITY_BACKGROUND,
+)
+from rate_limit import RateLimiter, TIER_SUBSCRIBER, TIER_FREE, TIER_SOFT_LIMIT
+from streaming import TelegramStreamWriter, stream_to_chat
+from tokens import count_message_tokens
+from quota import register_message
+from storage import Storage
+from message_log import MessageLog
+from user_cache import UserCache, load_user
+from dispatch import per_user_builder
+from intents import load_matcher
+from prompt_builder import PromptBuilder, PromptCacheStats
+from kb_retrieval import build_knowledge_base
+from semantic_memory import SemanticMemory
+from voice import VoiceTranscriber
+from webhook import WebhookServer
+from outbound import OutboundBot, OutboundLimiter
+from metrics import Registry, serve_metrics
+from profiler import Profiler, ProfilerBusy
+from usage import UsageLedger, anonymize_usage, usage_by_model, top_users, daily_user_load, threshold_report, cost
+from resilient import ResilientCompletions, AllModelsUnavailable, RETRYABLE
 
 
 # --- Загрузка ключей ---
@@ -18,96 +45,310 @@ load_dotenv()
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 ADMIN_ID = int(os.getenv('ADMIN_ID', 0))
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 8))
+LLM_MAX_QUEUE = int(os.getenv('LLM_MAX_QUEUE', 200))
+OPENAI_RPM = float(os.getenv('OPENAI_RPM', 500))  # квота OpenAI, запросов в минуту (0 — без ограничения)
+RATE_SUBSCRIBER_PER_MIN = float(os.getenv('RATE_SUBSCRIBER_PER_MIN', 20))
+RATE_FREE_PER_MIN = float(os.getenv('RATE_FREE_PER_MIN', 10))
+RATE_SOFT_LIMIT_PER_MIN = float(os.getenv('RATE_SOFT_LIMIT_PER_MIN', 3))  # после DAILY_DOWNGRADE_AT сообщений за день
+DAILY_DOWNGRADE_AT = int(os.getenv('DAILY_DOWNGRADE_AT', 50))  # после стольких сообщений за день — модель попроще
+DAILY_MESSAGE_LIMIT = int(os.getenv('DAILY_MESSAGE_LIMIT', 100))  # больше за день не отвечаем (подбирать по /usage)
+USAGE_FLUSH_INTERVAL = float(os.getenv('USAGE_FLUSH_INTERVAL', 30))  # как часто сбрасываем учёт токенов в базу, сек
+LLM_DEADLINE = float(os.getenv('LLM_DEADLINE', 45))  # сек на один запрос к модели вместе с повторами
+LLM_RETRIES = int(os.getenv('LLM_RETRIES', 2))
+LLM_HEDGE = os.getenv('LLM_HEDGE', '1') == '1'  # дублировать запрос, если он дольше p95
+LLM_BREAKER_FAILURES = int(os.getenv('LLM_BREAKER_FAILURES', 5))  # ошибок подряд до переключения на запасную модель
+LLM_BREAKER_COOLDOWN = float(os.getenv('LLM_BREAKER_COOLDOWN', 30))  # сек до пробного запроса к основной модели
+STREAM_IDLE_TIMEOUT = float(os.getenv('STREAM_IDLE_TIMEOUT', 30))  # сек без новых кусочков ответа — обрыв
+STREAM_REPLIES = os.getenv('STREAM_REPLIES', '1') == '1'
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 1.0))  # сек между правками сообщения
+RETENTION_INTERVAL = int(os.getenv('RETENTION_INTERVAL', 3600))  # как часто чистим старые данные, сек
+RETENTION_BATCH = int(os.getenv('RETENTION_BATCH', 500))  # пользователей за одну транзакцию
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', 6000))  # весь промпт: системные блоки + история + вопрос
+SUMMARY_TRIGGER_TOKENS = int(os.getenv('SUMMARY_TRIGGER_TOKENS', 2500))  # сколько несвёрнутой истории терпим
+SUMMARY_KEEP_RECENT = int(os.getenv('SUMMARY_KEEP_RECENT', 8))  # последние реплики не сворачиваем
+SUMMARY_FOLD_TOKENS = int(os.getenv('SUMMARY_FOLD_TOKENS', 4000))  # максимум за один проход
+SUMMARY_MAX_TOKENS = int(os.getenv('SUMMARY_MAX_TOKENS', 400))
+SUMMARY_MODEL = os.getenv('SUMMARY_MODEL', 'gpt-4o-mini')
+MESSAGE_FLUSH_INTERVAL_MS = int(os.getenv('MESSAGE_FLUSH_INTERVAL_MS', 500))  # как часто сбрасываем буфер сообщений
+MESSAGE_FLUSH_ROWS = int(os.getenv('MESSAGE_FLUSH_ROWS', 200))  # или раньше, если накопилось столько строк
+KB_DIR = os.getenv('KB_DIR', 'kb')  # дополнительные справочники *.txt с [разделами]
+KB_TOP_K = int(os.getenv('KB_TOP_K', 2))  # сколько разделов справочника добавлять в промпт
+KB_MIN_SCORE = float(os.getenv('KB_MIN_SCORE', 3.0))  # порог BM25, если тема не про бывшего
+MEMORY_TOP_K = int(os.getenv('MEMORY_TOP_K', 3))  # сколько давних реплик вспоминать
+MEMORY_MIN_SIMILARITY = float(os.getenv('MEMORY_MIN_SIMILARITY', 0.3))
+MEMORY_SNIPPET_CHARS = int(os.getenv('MEMORY_SNIPPET_CHARS', 500))
+MEMORY_BACKFILL_BATCH = int(os.getenv('MEMORY_BACKFILL_BATCH', 2000))  # сообщений за транзакцию при дозаполнении векторов
+VOICE_CACHE_SIZE = int(os.getenv('VOICE_CACHE_SIZE', 1000))  # сколько расшифровок голосовых держать в памяти
+VOICE_CHUNK_SECONDS = float(os.getenv('VOICE_CHUNK_SECONDS', 60))  # голосовые длиннее режутся на куски (нужны pydub и ffmpeg)
+INTENT_KEYWORDS_FILE = os.getenv('INTENT_KEYWORDS_FILE')  # JSON {группа: [ключи]} в дополнение к встроенным
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 300))  # сек, через сколько перечитываем пользователя из базы
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', 64))  # сколько апдейтов обрабатываем одновременно (1 — по одному)
+TG_GLOBAL_PER_SEC = float(os.getenv('TG_GLOBAL_PER_SEC', 30))  # исходящих запросов к Telegram в секунду на бота
+TG_CHAT_PER_SEC = float(os.getenv('TG_CHAT_PER_SEC', 1))  # сообщений в секунду в один личный чат
+TG_GROUP_PER_MIN = float(os.getenv('TG_GROUP_PER_MIN', 20))  # сообщений в минуту в группу
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9100))  # эндпоинт /metrics для Prometheus (0 — выключен)
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')  # куда /profile пишет стеки
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', 60))  # верхняя граница сеанса профилирования
+BOT_MODE = os.getenv('BOT_MODE', 'polling')  # polling или webhook
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # публичный адрес (https://...); если задан — регистрируем вебхук при старте
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')  # секрет из заголовка X-Telegram-Bot-Api-Secret-Token
 
 if not TELEGRAM_TOKEN or not OPENAI_API_KEY:
     raise ValueError("❌ Проверь .env — TELEGRAM_TOKEN или OPENAI_API_KEY не найдены!")
-
-client = OpenAI(api_key=OPENAI_API_KEY)
+if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+    raise ValueError("❌ Для BOT_MODE=webhook нужен WEBHOOK_SECRET!")
+
+client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+# Все запросы к OpenAI (чат и расшифровка) идут через общий ограничитель с очередью:
+# не больше LLM_MAX_CONCURRENCY одновременно и не чаще OPENAI_RPM, подписчики — вперёд
+llm = LLMScheduler(max_concurrency=LLM_MAX_CONCURRENCY, max_queue=LLM_MAX_QUEUE, rate_per_minute=OPENAI_RPM)
+# Чат-запросы: дедлайн, повторы с джиттером, дубль после p95 и переключение
+# на gpt-3.5-turbo, если gpt-4o-mini сбоит. Повторы SDK выключены — ими управляем сами.
+completions = ResilientCompletions(
+    client.with_options(max_retries=0),
+    fallbacks={"gpt-4o-mini": "gpt-3.5-turbo"},
+    deadline=LLM_DEADLINE,
+    retries=LLM_RETRIES,
+    hedge=LLM_HEDGE,
+    breaker_failures=LLM_BREAKER_FAILURES,
+    breaker_cooldown=LLM_BREAKER_COOLDOWN,
+    quota=llm.bucket  # повторы и дубли тоже расходуют квоту OPENAI_RPM
+)
+# Частота сообщений на пользователя: (сообщений в минуту, запас подряд) по тарифам
+rate_limiter = RateLimiter({
+    TIER_SUBSCRIBER: (RATE_SUBSCRIBER_PER_MIN, 5),
+    TIER_FREE: (RATE_FREE_PER_MIN, 3),
+    TIER_SOFT_LIMIT: (RATE_SOFT_LIMIT_PER_MIN, 2),
+})
 
 # --- База данных ---
-DB_PATH = "bot_memory.db"
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-cursor = conn.cursor()
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS users (
-    user_id INTEGER PRIMARY KEY,
-    first_message_time TIMESTAMP,
-    last_message_time TIMESTAMP,
-    free_messages INTEGER DEFAULT 10,
-    subscription_end TIMESTAMP,
-    voice_minutes_today INTEGER DEFAULT 0,
-    last_voice_reset TIMESTAMP,
-    daily_messages INTEGER DEFAULT 0,
-    last_daily_reset TIMESTAMP
-)
-''')
-
-# --- Таблица сообщений для памяти ---
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS messages (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    role TEXT,
-    content TEXT,
-    timestamp TIMESTAMP
+# Соединение, прагмы (WAL) и миграции схемы — в storage.py. Все запросы ниже
+# принимают conn первым аргументом и выполняются на потоке SQLite через db.run().
+DB_PATH = os.getenv('DB_PATH', 'bot_memory.db')
+db = Storage(DB_PATH)
+# Кэш пользователей: читается и меняется только на потоке SQLite, вместе с запросами
+user_cache = UserCache(max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+# --- Метрики: этапы обработки, модели, отказы ---
+# Гистограммы и счётчики живут в памяти процесса; наружу — /metrics и /stats
+metrics = Registry()
+turn_seconds = metrics.histogram("bot_turn_seconds", "Полное время обработки сообщения")
+stage_seconds = metrics.histogram("bot_stage_seconds", "Время этапов обработки сообщения", ["stage"])
+telegram_seconds = metrics.histogram("bot_telegram_request_seconds", "Запросы к Bot API", ["endpoint"])
+replies_total = metrics.counter("bot_replies_total", "Ответов по моделям", ["model"])
+detailed_total = metrics.counter("bot_detailed_replies_total", "Подробных ответов", ["reason"])
+rejections_total = metrics.counter("bot_rejections_total", "Отказов по лимитам", ["reason"])
+
+# --- Долговременная память: векторы прошлых сообщений подписчиков ---
+semantic_memory = SemanticMemory()
+
+# Индексируем только тех, у кого открыто окно памяти: остальным recall не нужен
+def index_messages(conn, rows):
+    rows = [r for r in rows if (u := load_user(conn, user_cache, r[1])) and u.memory_window_open()]
+    return semantic_memory.index(conn, rows)
+
+# Разовая задача JobQueue при старте — не на пути обработки сообщений
+async def backfill_message_vectors(context=None):
+    started = time.monotonic()
+    total = 0
+    try:
+        while True:
+            last_id, indexed = await db.run(
+                semantic_memory.backfill_batch, datetime.datetime.now(), MEMORY_BACKFILL_BATCH
+            )
+            if last_id is None:
+                break
+            total += indexed
+            await asyncio.sleep(0)  # отдаём цикл событий между пачками
+    except Exception as e:
+        print(f"[MEMORY BACKFILL ERROR] {e}")
+    print(f"[MEMORY BACKFILL] Проиндексировано сообщений: {total} за {time.monotonic() - started:.1f} с")
+    return total
+
+# --- Сохранение сообщений в память: буфер в памяти + пакетная запись ---
+message_log = MessageLog(
+    db, flush_interval=MESSAGE_FLUSH_INTERVAL_MS / 1000, max_rows=MESSAGE_FLUSH_ROWS,
+    on_flush=index_messages
 )
-''')
-conn.commit()
-
-# --- Сохранение сообщения в память ---
-def save_message(user_id, role, content):
-    cursor.execute(
-        "INSERT INTO messages (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
-        (user_id, role, content, datetime.datetime.now())
-    )
-    conn.commit()
+
+# --- Учёт токенов и времени ответов по пользователям, моделям и дням ---
+usage_ledger = UsageLedger(db, flush_interval=USAGE_FLUSH_INTERVAL)
 
 # --- Получение истории диалога ---
-def get_conversation_history(user_id):
-    user = get_user(user_id)
-    if not user:
+# Читаем с самых новых сообщений по индексу (user_id, id) и останавливаемся,
+# как только упираемся в бюджет токенов. Возвращаем в хронологическом порядке.
+# after_id — граница резюме: всё, что до неё, уже свёрнуто в summaries.
+# Ещё не записанные в базу реплики из message_log — самые свежие, берём их первыми.
+def get_conversation_history(conn, user_id, token_budget=None, after_id=0):
+    if token_budget is None:
+        token_budget = PROMPT_TOKEN_BUDGET
+    # Память доступна при активной подписке и ещё 14 дней после
+    user = load_user(conn, user_cache, user_id)
+    if not user or not user.memory_window_open():
         return []
-    now = datetime.datetime.now()
-    sub_end = user[4]  # subscription_end (строка ISO или None)
-    if sub_end:
-        sub_end_date = datetime.datetime.fromisoformat(sub_end)
-        # Память доступна при активной подписке и ещё 14 дней после
-        if now <= sub_end_date + datetime.timedelta(weeks=2):
-            cursor.execute("SELECT role, content FROM messages WHERE user_id=? ORDER BY id ASC", (user_id,))
-            rows = cursor.fetchall()
-            return [{"role": r, "content": c} for r, c in rows]
-    return []
+    history, used, backfill = [], 0, []
+    for role, content, tokens in reversed(message_log.rows_for(user_id)):
+        if used + tokens > token_budget:
+            history.reverse()
+            return history
+        used += tokens
+        history.append({"role": role, "content": content})
+    rows = conn.execute(
+        "SELECT id, role, content, token_count FROM messages WHERE user_id=? AND id>? ORDER BY id DESC",
+        (user_id, after_id)
+    )
+    for msg_id, role, content, tokens in rows:
+        if tokens is None:
+            # Старые строки без кэша — считаем один раз и сохраняем
+            tokens = count_message_tokens(content)
+            backfill.append((tokens, msg_id))
+        if used + tokens > token_budget:
+            break
+        used += tokens
+        history.append({"role": role, "content": content})
+    rows.close()
+    if backfill:
+        conn.executemany("UPDATE messages SET token_count=? WHERE id=?", backfill)
+        conn.commit()
+    history.reverse()
+    return history
+
+# --- Резюме долгой переписки ---
+# Старые реплики сворачиваются в одно резюме на пользователя, в промпт идут
+# резюме + свежие реплики после last_message_id. Обновляется фоном после ответа.
+SUMMARY_PROMPT = """
+Ты ведёшь краткое резюме переписки психолога-бота с собеседницей.
+Обнови резюме с учётом новых реплик: ключевые факты о её жизни и людях вокруг,
+что её беспокоит, что уже обсуждали и советовали, о чём договорились, как менялось состояние.
+Пиши сжато, от третьего лица, без оценок и без выдумок. Не больше 12 пунктов.
+"""
+
+def get_summary(conn, user_id):
+    row = conn.execute(
+        "SELECT summary, last_message_id, token_count FROM summaries WHERE user_id=?", (user_id,)
+    ).fetchone()
+    return row if row else (None, 0, 0)
+
+def save_summary(conn, user_id, summary, last_message_id):
+    conn.execute(
+        """INSERT INTO summaries (user_id, summary, last_message_id, token_count, updated_at)
+           VALUES (?, ?, ?, ?, ?)
+           ON CONFLICT(user_id) DO UPDATE SET summary=excluded.summary,
+               last_message_id=excluded.last_message_id, token_count=excluded.token_count,
+               updated_at=excluded.updated_at""",
+        (user_id, summary, last_message_id, count_message_tokens(summary), datetime.datetime.now())
+    )
+    conn.commit()
+
+def get_unsummarized_messages(conn, user_id, after_id):
+    return conn.execute(
+        "SELECT id, role, content, token_count FROM messages WHERE user_id=? AND id>? ORDER BY id ASC",
+        (user_id, after_id)
+    ).fetchall()
+
+summarizing_users = set()
+
+async def update_summary(user_id):
+    if user_id in summarizing_users:
+        return
+    summarizing_users.add(user_id)
+    try:
+        summary, last_id, _ = await db.run(get_summary, user_id)
+        rows = await db.run(get_unsummarized_messages, user_id, last_id)
+        raw_tokens = sum(t if t is not None else count_message_tokens(c) for _, _, c, t in rows)
+        if raw_tokens < SUMMARY_TRIGGER_TOKENS or len(rows) <= SUMMARY_KEEP_RECENT:
+            return
+
+        # Сворачиваем самые старые реплики, свежие SUMMARY_KEEP_RECENT оставляем как есть
+        fold, fold_tokens = [], 0
+        for msg_id, role, content, tokens in rows[:-SUMMARY_KEEP_RECENT]:
+            fold_tokens += tokens if tokens is not None else count_message_tokens(content)
+            if fold and fold_tokens > SUMMARY_FOLD_TOKENS:
+                break
+            fold.append((msg_id, role, content))
+        dialogue = "\n".join(
+            f"{'Она' if role == 'user' else 'Бот'}: {content}" for _, role, content in fold
+        )
+        async with llm.slot(PRIORITY_BACKGROUND):
+            started = time.perf_counter()
+            response, served_model = await completions.create_with_model(
+                model=SUMMARY_MODEL,
+                messages=[
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {"role": "user", "content": f"Текущее резюме:\n{summary or '—'}\n\nНовые реплики:\n{dialogue}"}
+                ],
+                max_tokens=SUMMARY_MAX_TOKENS,
+                temperature=0.3,
+                hedge=False  # фоновая задача: дубль запроса того не стоит
+            )
+        usage_ledger.record(user_id, served_model, "summary", response.usage, time.perf_counter() - started)
+        new_summary = (response.choices[0].message.content or "").strip()
+        if new_summary:
+            await db.run(save_summary, user_id, new_summary, fold[-1][0])
+    except Exception as e:
+        print(f"[SUMMARY ERROR] {user_id}: {e}")
+    finally:
+        summarizing_users.discard(user_id)
 
 # --- Функция автоудаления данных ---
-def delete_old_users_data():
-    now = datetime.datetime.now()
+# Правила:
+# 1) подписка завершилась > 14 дней назад;
+# 2) подписки никогда не было и пользователь не писал > 30 дней.
+# Удаляем пачками: одна пачка = одна транзакция, даты сравнивает сам SQLite.
+RETENTION_WHERE = """
+    (subscription_end IS NOT NULL AND julianday(subscription_end) < julianday(:sub_cutoff))
+    OR (subscription_end IS NULL AND last_message_time IS NOT NULL
+        AND julianday(last_message_time) < julianday(:idle_cutoff))
+"""
 
-    # 1. Удаляем тех, у кого подписка завершилась > 14 дней назад
-    cursor.execute("SELECT user_id, subscription_end FROM users WHERE subscription_end IS NOT NULL")
-    for user_id, sub_end in cursor.fetchall():
-        try:
-            end_date = datetime.datetime.fromisoformat(sub_end)
-            if now > end_date + datetime.timedelta(weeks=2):
-                cursor.execute("DELETE FROM messages WHERE user_id=?", (user_id,))
-                cursor.execute("DELETE FROM users WHERE user_id=?", (user_id,))
-                conn.commit()
-                print(f"[AUTO CLEAN] Подписка истекла >14 дней назад — данные пользователя {user_id} удалены.")
-        except Exception as e:
-            print(f"[AUTO CLEAN ERROR] {e}")
-
-    # 2. Удаляем тех, кто никогда не имел подписки и не писал >30 дней
-    cursor.execute("SELECT user_id, subscription_end, last_message_time FROM users WHERE subscription_end IS NULL")
-    for user_id, sub_end, last_message in cursor.fetchall():
-        try:
-            if last_message:
-                last_activity = datetime.datetime.fromisoformat(last_message)
-                if now > last_activity + datetime.timedelta(days=30):
-                    cursor.execute("DELETE FROM messages WHERE user_id=?", (user_id,))
-                    cursor.execute("DELETE FROM users WHERE user_id=?", (user_id,))
-                    conn.commit()
-                    print(f"[AUTO CLEAN] Без подписки и неактивен >30 дней — данные пользователя {user_id} удалены.")
-        except Exception as e:
-            print(f"[AUTO CLEAN ERROR] {e}")
+def purge_old_users_batch(conn, now, batch_size):
+    params = {
+        "sub_cutoff": now - datetime.timedelta(weeks=2),
+        "idle_cutoff": now - datetime.timedelta(days=30),
+        "limit": batch_size,
+    }
+    with conn:
+        user_ids = [r[0] for r in conn.execute(
+            f"DELETE FROM users WHERE user_id IN "
+            f"(SELECT user_id FROM users WHERE {RETENTION_WHERE} LIMIT :limit) RETURNING user_id",
+            params
+        ).fetchall()]
+        if not user_ids:
+            return 0, 0
+        placeholders = ",".join("?" * len(user_ids))
+        deleted_messages = conn.execute(
+            f"DELETE FROM messages WHERE user_id IN ({placeholders})", user_ids
+        ).rowcount
+        conn.execute(f"DELETE FROM summaries WHERE user_id IN ({placeholders})", user_ids)
+        conn.execute(f"DELETE FROM message_vectors WHERE user_id IN ({placeholders})", user_ids)
+        anonymize_usage(conn, user_ids)
+    user_cache.invalidate(*user_ids)
+    return len(user_ids), deleted_messages
+
+# Периодическая задача JobQueue — не на пути обработки сообщений
+async def delete_old_users_data(context=None):
+    started = time.monotonic()
+    now = datetime.datetime.now()
+    total_users = total_messages = 0
+    try:
+        while True:
+            users, messages = await db.run(purge_old_users_batch, now, RETENTION_BATCH)
+            total_users += users
+            total_messages += messages
+            if users < RETENTION_BATCH:
+                break
+            await asyncio.sleep(0)  # отдаём цикл событий между пачками
+    except Exception as e:
+        print(f"[AUTO CLEAN ERROR] {e}")
+    elapsed = time.monotonic() - started
+    print(f"[AUTO CLEAN] Удалено пользователей: {total_users}, сообщений: {total_messages} за {elapsed:.3f} с")
+    return total_users, total_messages, elapsed
 
 
 # --- Приветствие (фиксированное) ---
@@ -215,119 +456,84 @@ RELATIONSHIP_KB = """
 — Дай 2–3 естественных коротких варианта на выбор, без пафоса; избегай «супер-правильного» единственного ответа.
 """
 
+VARIANTS_HINT = "В конце ответа предложи 2–3 естественных варианта фраз/сообщений на выбор (без пафоса)."
+
+SUMMARY_PREFIX = "Что ты уже знаешь о собеседнице из прошлых разговоров:\n"
+MEMORY_PREFIX = "Она уже писала тебе раньше (может пригодиться, если связано с вопросом):\n"
+
+# Системные блоки промпта: статичные всегда идут первыми (их кэширует провайдер),
+# условные — после истории. Токены блоков считаются один раз при запуске.
+prompt_builder = PromptBuilder(
+    static_blocks=[PSYCHO_PROMPT, MESSAGING_INSERT],
+    conditional_blocks={
+        "template": UNIVERSAL_TEMPLATE,
+        "variants": VARIANTS_HINT,
+    },
+)
+prompt_cache_stats = PromptCacheStats()
+
+# Справочники режутся на [разделы] и индексируются при запуске; в промпт идут только
+# подходящие к сообщению разделы. Новые темы — файлы *.txt в KB_DIR.
+knowledge_base = build_knowledge_base({"relationships": RELATIONSHIP_KB}, KB_DIR)
+
 
 # --- Вспомогательные функции пользователя/лимитов ---
-def get_user(user_id):
-    cursor.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
-    return cursor.fetchone()
+def get_user(conn, user_id):
+    return conn.execute("SELECT * FROM users WHERE user_id=?", (user_id,)).fetchone()
 
-def add_or_update_user(user_id):
+def add_or_update_user(conn, user_id):
     now = datetime.datetime.now()
-    user = get_user(user_id)
+    user = get_user(conn, user_id)
     if user is None:
-        cursor.execute(
+        conn.execute(
             "INSERT INTO users (user_id, first_message_time, last_message_time, subscription_end, last_voice_reset, last_daily_reset) VALUES (?, ?, ?, ?, ?, ?)",
             (user_id, now, now, None, now, now)
         )
     else:
-        cursor.execute(
+        conn.execute(
             "UPDATE users SET last_message_time=? WHERE user_id=?",
             (now, user_id)
         )
     conn.commit()
 
-def can_send_free_message(user):
-    return user is None or (user[3] is not None and user[3] > 0)
-
-def decrement_free_message(user_id):
-    cursor.execute("UPDATE users SET free_messages = free_messages - 1 WHERE user_id=?", (user_id,))
+def grant_vip(conn, user_id):
+    conn.execute("""
+        UPDATE users
+        SET subscription_end = ?,
+            free_messages = 999999
+        WHERE user_id = ?
+    """, (
+        (datetime.datetime.now() + datetime.timedelta(days=365)).isoformat(),
+        user_id
+    ))
+    semantic_memory.index_user(conn, user_id)
     conn.commit()
+    user_cache.invalidate(user_id)
 
-def has_active_subscription(user):
-    if user is None or user[4] is None:
-        return False
-    now = datetime.datetime.now()
-    end_date = datetime.datetime.fromisoformat(user[4])
-    return now <= end_date
-
-def reset_daily_limit_if_needed(user_id, user):
+def check_voice_limit(conn, limits):
     now = datetime.datetime.now()
-    last_reset = datetime.datetime.fromisoformat(user[8]) if user[8] else None
+    last_reset = limits.last_voice_reset
     if last_reset is None or (now - last_reset).days >= 1:
-        cursor.execute("UPDATE users SET daily_messages=0, last_daily_reset=? WHERE user_id=?", (now, user_id))
+        conn.execute("UPDATE users SET voice_minutes_today=0, last_voice_reset=? WHERE user_id=?", (now, limits.user_id))
         conn.commit()
+        rec = user_cache.get(limits.user_id)
+        if rec is not None:
+            rec.voice_minutes_today = 0
+            rec.last_voice_reset = now
         return True
-    return False
+    return limits.voice_minutes_today < 20
 
-def increment_daily_messages(user_id):
-    cursor.execute("UPDATE users SET daily_messages = daily_messages + 1 WHERE user_id=?", (user_id,))
-    conn.commit()
-
-def check_voice_limit(user):
-    now = datetime.datetime.now()
-    last_reset = user[6]
-    if last_reset is None or (now - datetime.datetime.fromisoformat(last_reset)).days >= 1:
-        cursor.execute("UPDATE users SET voice_minutes_today=0, last_voice_reset=? WHERE user_id=?", (now, user[0]))
-        conn.commit()
-    return user[5] < 20
-
-def increment_voice_minutes(user_id, minutes):
-    cursor.execute("UPDATE users SET voice_minutes_today = voice_minutes_today + ? WHERE user_id=?", (minutes, user_id))
+def increment_voice_minutes(conn, user_id, minutes):
+    conn.execute("UPDATE users SET voice_minutes_today = voice_minutes_today + ? WHERE user_id=?", (minutes, user_id))
     conn.commit()
+    rec = user_cache.get(user_id)
+    if rec is not None:
+        rec.voice_minutes_today += minutes
 
 # --- Детекторы режимов ответа ---
-def wants_detailed_explicit(text: str) -> bool:
-    if not text:
-        return False
-    t = text.lower()
-    keys = [
-        "подробно", "развёрнуто", "развернуто", "с разбором",
-        "глубокий анализ", "проанализируй", "проанализировать",
-        "распиши", "пошагово", "с примерами", "подробный разбор"
-    ]
-    return any(k in t for k in keys)
-
-def wants_detailed_auto(text: str, history: list) -> bool:
-    if not text:
-        return False
-    t = text.lower()
-    complex_triggers = [
-        "почему", "объясни", "объяснишь", "анал", "разбор",
-        "что делать", "как поступить", "как быть",
-        "стоит ли", "нужно ли", "правильно ли", "это манипуляция",
-        "газлайт", "абьюз", "нарцис"
-    ]
-    long_enough = len(t) > 600
-    many_questions = t.count("?") >= 2
-    has_complex = any(k in t for k in complex_triggers)
-    recent_user_msgs = [m["content"].lower() for m in history[-6:] if m["role"] == "user"]
-    reformulate_signals = any(
-        any(k in msg for k in ["не подходит", "иначе", "по-другому", "не то", "распиши"])
-        for msg in recent_user_msgs
-    )
-    return long_enough or many_questions or has_complex or reformulate_signals
-
-def needs_variants(text: str) -> bool:
-    if not text:
-        return False
-    t = text.lower()
-    keys = [
-        "что ответить", "как ответить", "смс", "сообщение",
-        "написал", "написала", "переписка", "что сказать",
-        "здороваться", "не здороваться", "встреча",
-        "позвонить", "не звонить"
-    ]
-    return any(k in t for k in keys)
-def is_ex_topic(text: str) -> bool:
-    if not text:
-        return False
-    t = text.lower()
-    keys = [
-        "бывш", "экс", "вернуть", "no contact", "но контакт", "игнор",
-        "не писать", "тоска", "скучает", "вернется", "вернулся", "вернулась",
-        "помириться", "сойтись", "расставание", "разошлись"
-    ]
-    return any(k in t for k in keys)
+# Все ключевые слова — в одном скомпилированном классификаторе (intents.py),
+# дополнительные можно подложить JSON-файлом INTENT_KEYWORDS_FILE.
+intent_matcher = load_matcher(INTENT_KEYWORDS_FILE)
 
 # --- Поговорить (главная функция) ---
 async def talk_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -378,76 +584,99 @@ async def send_affirmation(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # --- Команда /start ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    add_or_update_user(update.effective_user.id)
-    delete_old_users_data()
+    await db.run(add_or_update_user, update.effective_user.id)
 
     first_name = update.effective_user.first_name or "друг"
     welcome_text = WELCOME_TEXT_TEMPLATE.format(name=first_name)
 
     await update.message.reply_text(welcome_text, reply_markup=MAIN_MENU_KB)
 
+# --- Голосовые: скачиваем в память и распознаём асинхронно ---
+async def download_voice(bot, file_id):
+    file = await bot.get_file(file_id)
+    buf = io.BytesIO()
+    await file.download_to_memory(buf)
+    return buf.getvalue()
+
+async def transcribe_voice(audio, priority=PRIORITY_FREE):
+    transcript = await llm.submit(
+        client.audio.transcriptions.create,
+        priority=priority,
+        model="gpt-4o-mini-transcribe",
+        file=audio
+    )
+    return transcript.text
+
+voice_transcriber = VoiceTranscriber(
+    transcribe_voice, cache_size=VOICE_CACHE_SIZE, chunk_seconds=VOICE_CHUNK_SECONDS
+)
+
 # --- Обработка сообщений ---
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    writer = None
+    turn_started = time.perf_counter()
     try:
         user_id = update.effective_user.id
 
         # --- VIP-доступ для себя ---
         if user_id == 1195425593:
-            cursor.execute("""
-                UPDATE users
-                SET subscription_end = ?,
-                    free_messages = 999999
-                WHERE user_id = ?
-            """, (
-                (datetime.datetime.now() + datetime.timedelta(days=365)).isoformat(),
-                user_id
-            ))
-            conn.commit()
-
-        add_or_update_user(user_id)
-        delete_old_users_data()
-        user = get_user(user_id)
-
-        reset_daily_limit_if_needed(user_id, user)
-
-        if not has_active_subscription(user) and not can_send_free_message(user):
-            await update.message.reply_text("🔒 Лимит бесплатных сообщений исчерпан. Оформи подписку, чтобы продолжить.")
+            await db.run(grant_vip, user_id)
+
+        # Частота сообщений: проверяем до учёта, чтобы отклонённое не списывало лимит.
+        # Никаких sleep в хендлере — сразу отвечаем, через сколько можно писать.
+        retry_after = rate_limiter.acquire(user_id)
+        if retry_after:
+            rejections_total.inc("rate_limited")
+            await update.message.reply_text(
+                f"⏳ Ты пишешь быстрее, чем я успеваю вдумчиво ответить. Напиши мне через {math.ceil(retry_after)} сек 🌿"
+            )
             return
-        elif user[3] > 0 and not has_active_subscription(user):
-            decrement_free_message(user_id)
 
-        increment_daily_messages(user_id)
+        # Учёт сообщения одной транзакцией: пользователь, дневной сброс, списание, счётчик
+        with stage_seconds.time("quota"):
+            limits = await db.run(register_message, user_id, cache=user_cache)
+
+        if not limits.allowed:
+            rejections_total.inc("free_exhausted")
+            await update.message.reply_text("🔒 Лимит бесплатных сообщений исчерпан. Оформи подписку, чтобы продолжить.")
+            return
 
-        # Лимит по моделям
-        if user[7] >= 100:
-            await update.message.reply_text("⏳ Лимит 100 сообщений в день. Пожалуйста, подожди немного.")
-            await asyncio.sleep(random.randint(5, 10))
+        # Лимит по моделям (daily_messages уже включает текущее сообщение)
+        if limits.daily_messages > DAILY_MESSAGE_LIMIT:
+            rejections_total.inc("daily_limit")
+            await update.message.reply_text(f"⏳ Лимит {DAILY_MESSAGE_LIMIT} сообщений в день. Пожалуйста, подожди немного.")
             return
-        elif user[7] >= 50:
+        elif limits.daily_messages > DAILY_DOWNGRADE_AT:
             model = "gpt-3.5-turbo"
-            await asyncio.sleep(random.randint(3, 5))
+            tier, priority = TIER_SOFT_LIMIT, PRIORITY_SOFT_LIMIT
+        elif limits.subscribed:
+            model = "gpt-4o-mini"
+            tier, priority = TIER_SUBSCRIBER, PRIORITY_SUBSCRIBER
         else:
             model = "gpt-4o-mini"
+            tier, priority = TIER_FREE, PRIORITY_FREE
+        rate_limiter.set_tier(user_id, tier)
 
         user_text = update.message.text or ""
 
         # --- Обработка голосовых ---
         if update.message.voice:
-            if not check_voice_limit(user):
+            with stage_seconds.time("quota"):
+                voice_allowed = await db.run(check_voice_limit, limits)
+            if not voice_allowed:
+                rejections_total.inc("voice_limit")
                 await update.message.reply_text("🎙 Лимит голосовых сообщений на сегодня исчерпан. Пиши текстом.")
                 return
-            increment_voice_minutes(user_id, update.message.voice.duration / 60)
-
-            file = await context.bot.get_file(update.message.voice.file_id)
-            file_path = "voice.ogg"
-            await file.download_to_drive(file_path)
-
-            with open(file_path, "rb") as audio_file:
-                transcript = client.audio.transcriptions.create(
-                    model="gpt-4o-mini-transcribe",
-                    file=audio_file
+            await db.run(increment_voice_minutes, user_id, update.message.voice.duration / 60)
+
+            voice = update.message.voice
+            with stage_seconds.time("transcription"):
+                user_text = await voice_transcriber.text_for(
+                    voice.file_unique_id,
+                    lambda: download_voice(context.bot, voice.file_id),
+                    voice.duration,
+                    priority=priority
                 )
-                user_text = transcript.text.strip()
 
             if not user_text.strip():
                 await update.message.reply_text("Отправь мне текст или голосовое сообщение.")
@@ -456,106 +685,400 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
         # --- Формируем историю диалога (память: срок подписки + 14 дней) ---
-        history = get_conversation_history(user_id)
-        messages = [{"role": "system", "content": PSYCHO_PROMPT}] + history + [
-            {"role": "user", "content": user_text}
-        ]
-
-        # Формируем порядок системных подсказок после PSYCHO_PROMPT
-        idx = 1  # вставляем дальше этой позиции
-
-        # (1) Всегда добавляем мягкое напоминание про "живой" стиль
-        messages.insert(idx, {"role": "system", "content": MESSAGING_INSERT})
-        idx += 1
-
-        # (2) Если тема про бывшего/возврат — добавляем справочник отношений
-        if is_ex_topic(user_text):
-            messages.insert(idx, {"role": "system", "content": RELATIONSHIP_KB})
-            idx += 1
-
-        # (3) Если запрос сложный/подробный/про бывшего — подключаем универсальный шаблон
-        if wants_detailed_explicit(user_text) or wants_detailed_auto(user_text, history) or is_ex_topic(user_text):
-            messages.insert(idx, {"role": "system", "content": UNIVERSAL_TEMPLATE})
-            idx += 1
-        
-
-
-
-        # Сохраняем сообщение пользователя
-        save_message(user_id, "user", user_text)
+        # Бюджет истории = общий бюджет минус системные блоки, которые попадут в промпт,
+        # и сам вопрос. Универсальный шаблон резервируем всегда: он может включиться
+        # уже по истории (просьба переформулировать).
+        with stage_seconds.time("retrieval"):
+            intent = intent_matcher.classify(user_text)
+            reserved_blocks = ["template"]
+            if intent.variants:
+                reserved_blocks.append("variants")
+
+            # Из справочников берём только подходящие к сообщению разделы. На тему бывшего —
+            # всегда хотя бы один раздел (первый — «Рамки»), на остальные — только явно подходящие.
+            kb_ids = knowledge_base.search(
+                user_text, KB_TOP_K, min_score=0.0 if intent.ex_topic else KB_MIN_SCORE
+            )
+            if intent.ex_topic and not kb_ids and len(knowledge_base):
+                kb_ids = [0]
+
+        with stage_seconds.time("history"):
+            summary, summary_upto, summary_tokens = (
+                await db.run(get_summary, user_id) if limits.memory_window_open else (None, 0, 0)
+            )
+            # Похожие реплики из давних разговоров (то, что уже не влезает в историю)
+            recalled = await db.run(
+                semantic_memory.recall, user_id, user_text, MEMORY_TOP_K, MEMORY_MIN_SIMILARITY
+            ) if limits.memory_window_open else []
+            recalled = [r[:MEMORY_SNIPPET_CHARS] for r in recalled]
+            memory_tokens = count_message_tokens(MEMORY_PREFIX + "\n".join("— " + r for r in recalled)) if recalled else 0
+            history_budget = max(0, PROMPT_TOKEN_BUDGET - prompt_builder.system_tokens(reserved_blocks)
+                                 - knowledge_base.tokens_for(kb_ids) - summary_tokens - memory_tokens
+                                 - count_message_tokens(user_text))
+            history = await db.run(get_conversation_history, user_id, history_budget, after_id=summary_upto)
+            in_history = {m["content"][:MEMORY_SNIPPET_CHARS] for m in history}
+            recalled = [r for r in recalled if r not in in_history]
 
         # --- Определяем режим ответа ---
-        explicit_detail = wants_detailed_explicit(user_text)
-        auto_detail = wants_detailed_auto(user_text, history)
+        explicit_detail = intent.detailed_explicit
+        auto_detail = intent.detailed_auto or bool(user_text and intent_matcher.reformulating(history))
         is_detailed = explicit_detail or auto_detail
+        if is_detailed:
+            detailed_total.inc("explicit" if explicit_detail else "auto")
 
         # если явно/авто детально — форсируем умнее модель
         if is_detailed and model == "gpt-3.5-turbo":
             model = "gpt-4o-mini"
 
-        need_variants = needs_variants(user_text)
         max_tokens_for_reply = 1500 if is_detailed else 500
+        mode = "detailed" if is_detailed else "short"
+
+        # --- Собираем промпт: статичное начало, условные подсказки — в конце ---
+        with stage_seconds.time("prompt"):
+            conditional_blocks = []
+            # Если запрос сложный/подробный/про бывшего — подключаем универсальный шаблон
+            if is_detailed or intent.ex_topic:
+                conditional_blocks.append("template")
+            # Просят, что ответить — 2–3 варианта фраз
+            if intent.variants:
+                conditional_blocks.append("variants")
+            summary_message = {"role": "system", "content": SUMMARY_PREFIX + summary} if summary else None
+            context_messages = []
+            if recalled:
+                context_messages.append({"role": "system", "content": MEMORY_PREFIX + "\n".join("— " + r for r in recalled)})
+            if kb_ids:
+                context_messages.append({"role": "system", "content": knowledge_base.render(kb_ids)})
+            messages = prompt_builder.build(history, user_text, conditional_blocks, summary_message, context_messages)
 
-        # --- Локальные системные подсказки поколению ---
-       
-        if need_variants:
-            messages.insert(idx, {
-                "role": "system",
-                "content": "В конце ответа предложи 2–3 естественных варианта фраз/сообщений на выбор (без пафоса)."
-            })
-            idx += 1
-
-
+        # Сохраняем сообщение пользователя
+        message_log.append(user_id, "user", user_text)
 
         # --- Генерация ответа ---
-        response = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            max_tokens=max_tokens_for_reply,
-            temperature=0.7 if is_detailed else 0.6
-        )
-
-        reply_text = response.choices[0].message.content
-
-        # Сохраняем ответ бота
-        save_message(user_id, "assistant", reply_text)
-
-        await update.message.reply_text(reply_text)
+        if STREAM_REPLIES:
+            # Стриминг: сразу плейсхолдер + «печатает», текст дописывается по мере генерации
+            writer = TelegramStreamWriter(
+                context.bot, update.effective_chat.id, edit_interval=STREAM_EDIT_INTERVAL
+            )
+            queued = time.perf_counter()
+            async with llm.slot(priority):
+                stage_seconds.observe(time.perf_counter() - queued, "llm_wait")
+                # генерация вместе с правками сообщения по ходу стрима
+                started = time.perf_counter()
+                with stage_seconds.time("llm"):
+                    await writer.start(reply_to_message_id=update.message.message_id)
+                    stream, served_model = await completions.create_with_model(
+                        model=model,
+                        messages=messages,
+                        max_tokens=max_tokens_for_reply,
+                        temperature=0.7 if is_detailed else 0.6,
+                        stream=True,
+                        stream_options={"include_usage": True}
+                    )
+                    reply_text, usage = await stream_to_chat(stream, writer, idle_timeout=STREAM_IDLE_TIMEOUT)
+            prompt_cache_stats.record(usage)
+            usage_ledger.record(user_id, served_model, mode, usage, time.perf_counter() - started)
+
+            # Ответ сохраняем один раз — когда стрим полностью дочитан
+            message_log.append(user_id, "assistant", reply_text)
+        else:
+            queued = time.perf_counter()
+            async with llm.slot(priority):
+                stage_seconds.observe(time.perf_counter() - queued, "llm_wait")
+                started = time.perf_counter()
+                with stage_seconds.time("llm"):
+                    response, served_model = await completions.create_with_model(
+                        model=model,
+                        messages=messages,
+                        max_tokens=max_tokens_for_reply,
+                        temperature=0.7 if is_detailed else 0.6
+                    )
+
+            reply_text = response.choices[0].message.content
+            prompt_cache_stats.record(response.usage)
+            usage_ledger.record(user_id, served_model, mode, response.usage, time.perf_counter() - started)
+
+            # Сохраняем ответ бота
+            message_log.append(user_id, "assistant", reply_text)
+
+            await update.message.reply_text(reply_text)
+
+        # модель, которая ответила на самом деле (с учётом запасной)
+        replies_total.inc(served_model)
+
+        # Резюме обновляем фоном — уже после того, как ответ ушёл
+        if limits.memory_window_open:
+            context.application.create_task(update_summary(user_id))
 
         if user_id == ADMIN_ID:
             print(f"[ADMIN LOG] Пользователь {user_id}: {user_text}")
 
+    except LLMQueueFull:
+        rejections_total.inc("queue_full")
+        await update.message.reply_text("⏳ Сейчас очень много обращений. Напиши мне ещё раз через минутку.")
+        print(f"[LLM QUEUE FULL] {llm.stats()}")
     except Exception as e:
-        await update.message.reply_text(f"⚠ Произошла ошибка: {e}")
-        if user_id == ADMIN_ID:
-            print(f"[ADMIN ERROR] {e}")
+        # Текст ошибки пользователю не показываем — только в лог
+        print(f"[ERROR] {type(e).__name__}: {e}")
+        text = LLM_UNAVAILABLE_TEXT if isinstance(e, (AllModelsUnavailable, *RETRYABLE)) else ERROR_TEXT
+        try:
+            if writer is not None and writer.message_id:
+                await writer.finish(text)
+            else:
+                await update.message.reply_text(text)
+        except Exception as e2:
+            print(f"[ERROR] Не удалось сообщить об ошибке: {e2}")
+    finally:
+        turn_seconds.observe(time.perf_counter() - turn_started)
+
+ERROR_TEXT = "⚠ Что-то пошло не так. Напиши мне ещё раз, пожалуйста 🌿"
+LLM_UNAVAILABLE_TEXT = "⏳ Я сейчас отвечаю медленнее обычного. Напиши мне ещё раз через минутку 🌿"
+
+# --- Меню: кнопка -> обработчик, всё остальное — в разговор ---
+MAIN_MENU = {
+    "Поговорить": talk_entry,
+    "Записка от меня": send_note,
+    "Обними меня": send_hug,
+    "Аффирмация дня": send_affirmation,
+}
+
+menu_router = MenuRouter(fallback=handle_message)
+menu_router.add_menu(MAIN_MENU)
+# Подменю «Мне тяжело»
+menu_router.add_menu(ANXIETY_MENU)    # Тревога (и само подменю, «Назад»)
+menu_router.add_menu(TEARS_MENU)      # Слёзы
+menu_router.add_menu(LONELY_MENU)     # Одиночество
+
+# --- Состояние очереди LLM (только для админа) ---
+async def queue_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        return
+    st = llm.stats()
+    rs = completions.stats()
+    ts = outbound_limiter.stats()
+    breakers = ", ".join(f"{m}: {b['state']}" for m, b in rs["breakers"].items()) or "—"
+    await update.message.reply_text(
+        "📊 Очередь LLM\n"
+        f"В работе: {st['in_flight']}/{st['max_concurrency']}\n"
+        f"В очереди: {st['queue_depth']}\n"
+        f"Выполнено: {st['completed']}, отклонено: {st['rejected']}\n"
+        f"Сдержано лимитом частоты: {rate_limiter.throttled}\n"
+        f"Telegram: запросов {ts['requests']}, пауз RetryAfter {ts['flood_waits']}, ждали {ts['waited_s']} с\n"
+        f"Голосовые из кэша: {voice_transcriber.hits}, распознано: {voice_transcriber.misses}\n"
+        f"Промпт из кэша провайдера: {prompt_cache_stats.ratio:.0%} (последний {prompt_cache_stats.last_ratio:.0%})\n"
+        f"Ожидание: среднее {st['avg_wait_ms']} мс, макс {st['max_wait_ms']} мс, последнее {st['last_wait_ms']} мс\n"
+        f"Модели: {breakers}\n"
+        f"Повторы: {rs['retries']}, таймауты: {rs['timeouts']}, ошибки: {rs['failed']}, "
+        f"на запасной модели: {rs['fallback_calls']}, дубли: {rs['hedges']} (выиграли {rs['hedge_wins']}), "
+        f"ждали квоту на повторы: {rs['quota_waited_s']} с"
+    )
+
+# --- Задержки по этапам (только для админа) ---
+STAGES = ("quota", "transcription", "retrieval", "history", "prompt", "llm_wait", "llm")
+
+async def latency_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        return
+
+    def ms(value):
+        return f"{value * 1000:.0f}" if value is not None else "—"
+
+    lines = ["⏱ Задержки, p50 / p95 мс (количество)"]
+    for stage in STAGES:
+        if stage_seconds.count(stage):
+            lines.append(f"{stage}: {ms(stage_seconds.quantile(0.5, stage))} / "
+                         f"{ms(stage_seconds.quantile(0.95, stage))} ({stage_seconds.count(stage)})")
+    lines.append(f"Ход целиком: {ms(turn_seconds.quantile(0.5))} / {ms(turn_seconds.quantile(0.95))} "
+                 f"({turn_seconds.count()})")
+    models = ", ".join(f"{labels[0]}: {n}" for labels, n in replies_total.values.items()) or "—"
+    rejected = ", ".join(f"{labels[0]}: {n}" for labels, n in rejections_total.values.items()) or "—"
+    lines.append(f"Ответы по моделям: {models}")
+    lines.append(f"Подробные: по просьбе {detailed_total.value('explicit')}, авто {detailed_total.value('auto')}")
+    lines.append(f"Отказы: {rejected}")
+    await update.message.reply_text("\n".join(lines))
+
+# --- Расход токенов за последние дни: /usage [дней] (только для админа) ---
+async def usage_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        return
+    try:
+        days = max(1, int(context.args[0])) if context.args else 7
+    except ValueError:
+        await update.message.reply_text("Использование: /usage [дней]")
+        return
+    await usage_ledger.flush()
+    since = (datetime.date.today() - datetime.timedelta(days=days - 1)).isoformat()
+    by_model = await db.run(usage_by_model, since)
+    users = await db.run(top_users, since)
+    load = threshold_report(await db.run(daily_user_load, since), DAILY_DOWNGRADE_AT, DAILY_MESSAGE_LIMIT)
+
+    lines = [f"💰 Расход за {days} дн."]
+    total_cost = 0.0
+    for model, mode, calls, prompt, completion, cached, wall_ms in by_model:
+        price = cost(model, prompt, completion, cached)
+        total_cost += price or 0.0
+        lines.append(
+            f"{model} / {mode}: {calls} отв., вход {prompt} (кэш {cached}), выход {completion}, "
+            f"в среднем {wall_ms / calls / 1000:.1f} с" + (f", ${price:.3f}" if price is not None else "")
+        )
+    if not by_model:
+        lines.append("—")
+    lines.append(f"Итого: ${total_cost:.3f}")
+    if users:
+        lines.append("")
+        lines.append("Больше всего токенов:")
+        lines += [f"  {uid}: {calls} отв., {prompt + completion} ток." for uid, calls, prompt, completion in users]
+    if load:
+        lines += [
+            "",
+            f"Ответов в день на пользователя: p50 {load['p50']}, p90 {load['p90']}, p99 {load['p99']}, макс {load['max']}",
+            f"Дней выше порога {DAILY_DOWNGRADE_AT} (понижение модели): {load['over_downgrade_share']:.1%} "
+            f"— {load['over_downgrade_tokens']:.0%} токенов",
+            f"Дней, упёршихся в лимит {DAILY_MESSAGE_LIMIT}: {load['at_limit_share']:.1%}",
+        ]
+    await update.message.reply_text("\n".join(lines))
+
+# --- Профилирование по запросу: /profile [секунды] (только для админа) ---
+# Сеанс идёт фоновой задачей — обработка сообщений не ждёт его окончания.
+profiler = Profiler(PROFILE_DIR, max_seconds=PROFILE_MAX_SECONDS)
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        return
+    if profiler.running:
+        await update.message.reply_text("🔬 Профилирование уже идёт")
+        return
+    try:
+        seconds = min(float(context.args[0]), PROFILE_MAX_SECONDS) if context.args else 15.0
+    except ValueError:
+        await update.message.reply_text("Использование: /profile [секунды]")
+        return
+    await update.message.reply_text(f"🔬 Снимаю профиль {seconds:.0f} с…")
+    context.application.create_task(send_profile(update, seconds))
+
+async def send_profile(update: Update, seconds: float):
+    try:
+        path, summary = await profiler.run(seconds)
+        await update.message.reply_text(summary)
+        with open(path, "rb") as f:
+            await update.message.reply_document(f, filename=os.path.basename(path))
+    except ProfilerBusy:
+        await update.message.reply_text("🔬 Профилирование уже идёт")
+    except Exception as e:
+        print(f"[PROFILE] {type(e).__name__}: {e}")
+
+metrics_server = None
+
+async def startup(app):
+    global metrics_server
+    message_log.start()
+    usage_ledger.start()
+    if METRICS_PORT:
+        metrics_server = await serve_metrics(metrics, METRICS_LISTEN, METRICS_PORT)
+
+# --- Корректная остановка: дописываем буфер сообщений и закрываем базу ---
+async def shutdown(app):
+    if metrics_server is not None:
+        metrics_server.close()
+    await message_log.stop()
+    await usage_ledger.stop()
+    db.close()
+
+# --- Исходящие сообщения: общий лимит, лимит на чат, RetryAfter и деление длинных текстов ---
+outbound_limiter = OutboundLimiter(
+    global_per_sec=TG_GLOBAL_PER_SEC, chat_per_sec=TG_CHAT_PER_SEC, group_per_min=TG_GROUP_PER_MIN,
+    latency=telegram_seconds
+)
+
+# Счётчики, которые и так ведут компоненты, — читаются только при запросе метрик
+metrics.callback("bot_llm_in_flight", "Запросов к LLM в работе", lambda: llm.in_flight)
+metrics.callback("bot_llm_queue_depth", "Запросов к LLM в очереди", lambda: llm.queue_depth)
+metrics.callback("bot_llm_rejected_total", "Отказов из-за переполненной очереди LLM", lambda: llm.rejected, kind="counter")
+metrics.callback("bot_llm_retries_total", "Повторов запросов к LLM", lambda: completions.retried, kind="counter")
+metrics.callback("bot_llm_timeouts_total", "Таймаутов запросов к LLM", lambda: completions.timeouts, kind="counter")
+metrics.callback("bot_llm_fallback_total", "Запросов, ушедших на запасную модель", lambda: completions.fallback_calls, kind="counter")
+metrics.callback("bot_llm_hedges_total", "Дублированных запросов к LLM", lambda: completions.hedges, kind="counter")
+metrics.callback(
+    "bot_llm_breaker_open", "Автомат модели открыт (1) или нет (0)",
+    lambda: {m: int(b.state != "closed") for m, b in completions.breakers.items()}, ["model"]
+)
+metrics.callback("bot_telegram_flood_waits_total", "Ответов RetryAfter от Telegram", lambda: outbound_limiter.flood_waits, kind="counter")
+metrics.callback("bot_user_cache_hits_total", "Попаданий в кэш пользователей", lambda: user_cache.hits, kind="counter")
+metrics.callback("bot_user_cache_misses_total", "Промахов кэша пользователей", lambda: user_cache.misses, kind="counter")
+metrics.callback("bot_voice_cache_hits_total", "Голосовых из кэша расшифровок", lambda: voice_transcriber.hits, kind="counter")
+metrics.callback("bot_prompt_cached_ratio", "Доля промпта из кэша провайдера", lambda: round(prompt_cache_stats.ratio, 4))
+metrics.callback("bot_message_log_pending", "Сообщений в буфере записи", lambda: message_log.pending)
+metrics.callback("bot_usage_pending", "Ключей учёта токенов до сброса в базу", lambda: usage_ledger.pending)
+
+# --- Режим вебхука ---
+# Апдейты приходят на свой HTTP-сервер и кладутся в ту же очередь приложения,
+# что и при polling, — дальше те же обработчики и тот же порядок по пользователям.
+# Вебхук при остановке не снимаем: пока бот перезапускается, Telegram копит апдейты.
+async def run_webhook(app):
+    async def enqueue(data):
+        await app.update_queue.put(Update.de_json(data, app.bot))
+
+    server = WebhookServer(enqueue, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await app.initialize()
+    try:
+        await app.post_init(app)
+        await app.start()
+        await server.start()
+        if WEBHOOK_URL:
+            await app.bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES
+            )
+        await stop.wait()
+    finally:
+        await server.stop()
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+        await app.post_shutdown(app)
 
 # --- Запуск ---
 if __name__ == "__main__":
     try:
         print("🚀 Запуск бота...")
-        delete_old_users_data()
 
-        app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+        bot = OutboundBot(
+            TELEGRAM_TOKEN,
+            request=HTTPXRequest(connection_pool_size=256),
+            get_updates_request=HTTPXRequest(),
+            rate_limiter=outbound_limiter
+        )
+        builder = ApplicationBuilder().bot(bot).post_init(startup).post_shutdown(shutdown)
+        if UPDATE_CONCURRENCY > 1:
+            # Разные пользователи обрабатываются параллельно, апдейты одного — по очереди
+            builder = per_user_builder(builder, UPDATE_CONCURRENCY)
+        app = builder.build()
+
+        # 0) Автоудаление старых данных — фоновой задачей, первый прогон сразу при старте
+        app.job_queue.run_repeating(delete_old_users_data, interval=RETENTION_INTERVAL, first=0)
+        # Векторы для старой переписки — один раз при старте, пачками
+        app.job_queue.run_once(backfill_message_vectors, when=0)
 
         # 1) /start
         app.add_handler(CommandHandler("start", start))
-
-        # 2) Кнопки главного меню
-        app.add_handler(MessageHandler(filters.TEXT & filters.Regex(r"^Поговорить$"), talk_entry))
-        app.add_handler(MessageHandler(filters.TEXT & filters.Regex(r"^Записка от меня$"), send_note))
-        app.add_handler(MessageHandler(filters.TEXT & filters.Regex(r"^Обними меня$"), send_hug))
-        app.add_handler(MessageHandler(filters.TEXT & filters.Regex(r"^Аффирмация дня$"), send_affirmation))
-
-        # 3) Подменю «Мне тяжело»
-        setup_anxiety_block(app)       # Тревога
-        setup_tears_block(app)         # Слёзы
-        setup_loneliness_block(app)    # Одиночество
-
-        # 4) Общий обработчик текста/голоса
-        app.add_handler(MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.VOICE, handle_message))
-
-        print("✅ Бот запущен и слушает сообщения...")
-        app.run_polling()
+        app.add_handler(CommandHandler("queue", queue_stats))
+        app.add_handler(CommandHandler("stats", latency_stats))
+        app.add_handler(CommandHandler("profile", profile_command))
+        app.add_handler(CommandHandler("usage", usage_stats))
+
+        # 2) Кнопки меню и весь остальной текст/голос — одним обработчиком:
+        #    кнопка ищется в словаре, всё прочее уходит в handle_message
+        app.add_handler(menu_router.handler())
+
+        print(f"✅ Бот запущен и слушает сообщения ({BOT_MODE})...")
+        if BOT_MODE == "webhook":
+            asyncio.run(run_webhook(app))
+        else:
+            app.run_polling()
     except Exception as e:
         print(f"❌ Ошибка запуска бота: {e}")
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from telegram import Update
+from telegram.ext import ContextTypes, MessageHandler, filters
+
+
+# --- Единый роутер кнопок меню ---
+# Вместо цепочки MessageHandler с Regex на каждую кнопку — один обработчик и
+# словарь {текст кнопки: функция}. Любое сообщение разбирается одним поиском
+# в словаре: совпало с кнопкой — её функция, нет — fallback (разговор с LLM).
+# Меню и подменю описываются в модулях блоков словарями и подключаются через
+# add_menu(); сколько бы их ни было, стоимость разбора сообщения не растёт.
+class MenuRouter:
+    def __init__(self, fallback):
+        self.fallback = fallback
+        self.routes = {}
+
+    def add(self, label: str, callback):
+        current = self.routes.get(label)
+        if current is not None and current is not callback:
+            raise ValueError(f"Кнопка «{label}» уже занята: {current.__name__}")
+        self.routes[label] = callback
+
+    def add_menu(self, menu: dict):
+        for label, callback in menu.items():
+            self.add(label, callback)
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        message = update.message
+        callback = self.routes.get(message.text) if message is not None and message.text else None
+        return await (callback or self.fallback)(update, context)
+
+    # Текст (кроме команд) и голосовые — голосовые сразу идут в fallback
+    def handler(self) -> MessageHandler:
+        return MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.VOICE, self.dispatch)
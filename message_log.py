@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import datetime
+from tokens import count_message_tokens
+
+INSERT_MESSAGE = "INSERT INTO messages (user_id, role, content, timestamp, token_count) VALUES (?, ?, ?, ?, ?)"
+
+
+# --- Отложенная запись сообщений (write-behind) ---
+# append() только кладёт строку в память, фоновая задача сбрасывает накопленное
+# одной транзакцией executemany раз в flush_interval секунд или при max_rows строк.
+#
+# Чтение своих записей: rows_for() и сброс (_write_batch) выполняются на потоке
+# SQLite, а он однопоточный — поэтому строка видна либо в буфере, либо уже в
+# таблице, но никогда в обоих местах сразу и никогда ни в одном.
+#
+# on_flush(conn, rows) вызывается уже после коммита, отдельной транзакцией, со
+# строками (message_id, user_id, role, content) — например, чтобы проиндексировать
+# их. Его ошибка только пишется в лог: сообщения к этому моменту уже сохранены.
+class MessageLog:
+    def __init__(self, storage, flush_interval: float = 0.5, max_rows: int = 200, on_flush=None):
+        self.storage = storage
+        self.on_flush = on_flush
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self._pending = []
+        self._full = asyncio.Event()
+        self._task = None
+        self.flushes = 0
+        self.flushed_rows = 0
+
+    def append(self, user_id, role, content):
+        self._pending.append(
+            (user_id, role, content, datetime.datetime.now(), count_message_tokens(content))
+        )
+        if len(self._pending) >= self.max_rows:
+            self._full.set()
+
+    # Вызывать только на потоке SQLite (внутри функций, переданных в storage.run)
+    def rows_for(self, user_id):
+        return [(role, content, tokens) for uid, role, content, _, tokens in self._pending[:] if uid == user_id]
+
+    def _write_batch(self, conn):
+        batch = self._pending[:]
+        if not batch:
+            return 0
+        with conn:
+            conn.executemany(INSERT_MESSAGE, batch)
+            # Вставка идёт одной транзакцией на единственном соединении, так что
+            # AUTOINCREMENT выдал пачке подряд идущие id, последний — last_insert_rowid()
+            last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        # Новые строки дописываются только в конец, так что убираем ровно сброшенные
+        del self._pending[:len(batch)]
+        if self.on_flush is not None:
+            first_id = last_id - len(batch) + 1
+            try:
+                with conn:
+                    self.on_flush(conn, [
+                        (first_id + i, uid, role, content)
+                        for i, (uid, role, content, _, _) in enumerate(batch)
+                    ])
+            except Exception as e:
+                print(f"[MESSAGE LOG] on_flush: {type(e).__name__}: {e}")
+        return len(batch)
+
+    async def flush(self):
+        written = await self.storage.run(self._write_batch)
+        if written:
+            self.flushes += 1
+            self.flushed_rows += written
+        return written
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"[MESSAGE LOG ERROR] {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    # При остановке бота дописываем всё, что осталось в памяти
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import math
+import re
+import time
+from collections import OrderedDict
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter, ExtBot
+from rate_limit import TokenBucket
+
+TELEGRAM_TEXT_LIMIT = 4096
+TAG_RE = re.compile(r"<(/?)([a-zA-Z][\w-]*)[^>]*>")
+HTML_RESERVE = 64  # место под закрывающие теги в конце куска
+# Эти методы Telegram ограничивает по частоте в каждом чате (sendChatAction — нет)
+CHAT_LIMITED = ("send", "edit", "copy", "forward")
+
+
+# --- Деление длинного текста на сообщения ---
+# Режем по абзацам, потом по строкам, предложениям и пробелам — и только в
+# крайнем случае посреди слова. В HTML не режем внутри тега или сущности (&amp;),
+# а открытые теги закрываем в конце куска и открываем заново в начале следующего.
+def split_message(text: str, limit: int = TELEGRAM_TEXT_LIMIT, html: bool = False):
+    if len(text) <= limit:
+        return [text]
+    chunks = []
+    open_tags = []  # [(имя, открывающий тег)]
+    rest = text
+    while rest:
+        prefix = "".join(tag for _, tag in open_tags)
+        budget = limit - len(prefix) - (HTML_RESERVE if html else 0)
+        if len(rest) <= budget:
+            piece, rest = rest, ""
+        else:
+            cut = _cut_point(rest, budget, html)
+            piece, rest = rest[:cut].rstrip(), rest[cut:].lstrip()
+        if html:
+            for m in TAG_RE.finditer(piece):
+                name = m.group(2).lower()
+                if not m.group(1):
+                    open_tags.append((name, m.group(0)))
+                else:
+                    for i in range(len(open_tags) - 1, -1, -1):
+                        if open_tags[i][0] == name:
+                            del open_tags[i]
+                            break
+            closing = "".join(f"</{name}>" for name, _ in reversed(open_tags))
+            chunks.append(prefix + piece + closing)
+        else:
+            chunks.append(piece)
+    return [c for c in chunks if c.strip()]
+
+
+def _cut_point(text: str, budget: int, html: bool) -> int:
+    window = text[:budget]
+    for sep in ("\n\n", "\n", ". ", " "):
+        pos = window.rfind(sep)
+        if pos > budget // 2:
+            cut = pos + len(sep)
+            break
+    else:
+        cut = budget
+    if html:
+        head = text[:cut]
+        if head.rfind("<") > head.rfind(">"):
+            cut = head.rfind("<")
+        amp = head.rfind("&")
+        if amp > head.rfind(";") and cut - amp < 10:
+            cut = amp
+    return max(cut, 1)
+
+
+# --- Единый ограничитель исходящих запросов к Bot API ---
+# Через него проходят все вызовы бота (ApplicationBuilder().rate_limiter):
+#   * общий лимит ~30 запросов в секунду на бота;
+#   * в каждом чате: личка — 1 сообщение в секунду с небольшим запасом,
+#     группы — 20 в минуту;
+#   * RetryAfter: чат (или весь бот) ставится на паузу на указанное время,
+#     запрос повторяется сам — пользователь не видит ошибку.
+# rate_limit_args — сколько раз повторять после RetryAfter; 0 — не ждать паузу,
+# а сразу вернуть RetryAfter (промежуточные правки стрима проще пропустить).
+# latency — гистограмма (metrics.Histogram) для времени ответа Bot API по методам.
+class OutboundLimiter(BaseRateLimiter):
+    def __init__(self, global_per_sec: float = 30, chat_per_sec: float = 1, chat_burst: float = 3,
+                 group_per_min: float = 20, max_retries: int = 3, max_chats: int = 50000, latency=None):
+        self.global_bucket = TokenBucket(global_per_sec, global_per_sec)
+        self.chat_per_sec = chat_per_sec
+        self.chat_burst = chat_burst
+        self.group_per_min = group_per_min
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self.latency = latency
+        self._chats = OrderedDict()  # chat_id -> [ведро, пауза до]
+        self._global_blocked_until = 0.0
+        self.requests = 0
+        self.flood_waits = 0
+        self.waited = 0.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat(self, chat_id):
+        state = self._chats.get(chat_id)
+        if state is None:
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(self.chat_per_sec, self.chat_burst)
+            else:
+                bucket = TokenBucket(self.group_per_min / 60.0, self.chat_burst)
+            state = self._chats[chat_id] = [bucket, 0.0]
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return state
+
+    async def _take(self, bucket):
+        while True:
+            wait = bucket.try_take()
+            if wait == 0.0:
+                return
+            self.waited += wait
+            await asyncio.sleep(wait)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        max_retries = self.max_retries if rate_limit_args is None else rate_limit_args
+        chat_id = data.get("chat_id")
+        state = self._chat(chat_id) if chat_id is not None else None
+        limited = state is not None and endpoint.startswith(CHAT_LIMITED) and endpoint != "sendChatAction"
+        for attempt in range(max_retries + 1):
+            blocked_until = max(self._global_blocked_until, state[1] if state else 0.0)
+            wait = blocked_until - time.monotonic()
+            if wait > 0:
+                if max_retries == 0:
+                    raise RetryAfter(math.ceil(wait))
+                self.waited += wait
+                await asyncio.sleep(wait)
+            if limited:
+                await self._take(state[0])
+            await self._take(self.global_bucket)
+            self.requests += 1
+            started = time.perf_counter()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.flood_waits += 1
+                until = time.monotonic() + float(e.retry_after)
+                if state is not None:
+                    state[1] = until
+                else:
+                    self._global_blocked_until = until
+                print(f"[OUTBOUND] {endpoint}: пауза {e.retry_after} с (чат {chat_id})")
+                if attempt >= max_retries:
+                    raise
+            finally:
+                if self.latency is not None:
+                    self.latency.observe(time.perf_counter() - started, endpoint)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "flood_waits": self.flood_waits,
+            "waited_s": round(self.waited, 1),
+            "chats": len(self._chats),
+        }
+
+
+# --- Бот, который сам делит длинные сообщения ---
+# Любой send_message/reply_text длиннее 4096 символов уходит несколькими
+# сообщениями подряд: ответ — на первом куске, клавиатура — на последнем.
+# Куски идут друг за другом без пауз, пока хватает запаса в ведре чата.
+class OutboundBot(ExtBot):
+    async def send_message(self, chat_id, text, *args, **kwargs):
+        if args or kwargs.get("entities") or len(text) <= TELEGRAM_TEXT_LIMIT:
+            return await super().send_message(chat_id, text, *args, **kwargs)
+        parse_mode = kwargs.get("parse_mode")
+        html = isinstance(parse_mode, str) and parse_mode.upper() == "HTML"
+        parts = split_message(text, html=html)
+        reply_markup = kwargs.pop("reply_markup", None)
+        message = None
+        for i, part in enumerate(parts):
+            extra = dict(kwargs)
+            if i > 0:
+                extra.pop("reply_to_message_id", None)
+            if i == len(parts) - 1 and reply_markup is not None:
+                extra["reply_markup"] = reply_markup
+            message = await super().send_message(chat_id, part, **extra)
+        return message
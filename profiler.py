@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# --- Профилирование по запросу админа ---
+# Пока сеанс не запущен, ничего не работает: ни потока, ни хуков, ни счётчиков.
+# Сеанс ограничен по времени и состоит из трёх частей:
+#   * сэмплер — отдельный поток раз в interval снимает стеки всех потоков
+#     через sys._current_frames() (цикл событий не останавливается и не трогается);
+#   * замер задержки цикла — корутина спит interval и смотрит, насколько позже проснулась;
+#   * снимок задач asyncio в конце — сколько каких корутин и где они ждут.
+# Полные стеки пишутся в файл в формате collapsed (flamegraph.pl, speedscope),
+# в чат уходит короткая сводка.
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    path = code.co_filename
+    if path.startswith(ROOT):
+        path = os.path.relpath(path, ROOT)
+    else:
+        path = os.path.basename(path)
+    return f"{path}:{code.co_name}"
+
+
+def _stack(frame, max_depth: int = 64):
+    names = []
+    while frame is not None and len(names) < max_depth:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+
+class _Sampler(threading.Thread):
+    def __init__(self, interval: float, max_depth: int):
+        super().__init__(name="profiler-sampler", daemon=True)
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = Counter()  # "поток;кадр;кадр…" -> число сэмплов
+        self.samples = 0
+        self._done = threading.Event()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self._done.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = _stack(frame, self.max_depth)
+                self.stacks[";".join([names.get(ident, str(ident))] + stack)] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+async def _measure_lag(interval: float, until: float, lags: list):
+    loop = asyncio.get_running_loop()
+    while loop.time() < until:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - started - interval))
+
+
+def task_dump():
+    groups = Counter()
+    lines = []
+    for task in asyncio.all_tasks():
+        coro = task.get_coro()
+        name = getattr(coro, "__qualname__", type(coro).__name__)
+        frames = task.get_stack(limit=1)
+        where = f"{_frame_name(frames[0])}:{frames[0].f_lineno}" if frames else "—"
+        groups[name] += 1
+        lines.append(f"{task.get_name()} {name} @ {where}")
+    return groups, sorted(lines)
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Profiler:
+    def __init__(self, out_dir: str = "profiles", interval: float = 0.005, lag_interval: float = 0.05,
+                 max_seconds: float = 60, max_depth: int = 64):
+        self.out_dir = out_dir
+        self.interval = interval
+        self.lag_interval = lag_interval
+        self.max_seconds = max_seconds
+        self.max_depth = max_depth
+        self.running = False
+
+    async def run(self, seconds: float):
+        if self.running:
+            raise ProfilerBusy()
+        seconds = max(1.0, min(float(seconds), self.max_seconds))
+        self.running = True
+        loop_thread = threading.current_thread().name
+        lags = []
+        sampler = _Sampler(self.interval, self.max_depth)
+        started = time.time()
+        loop = asyncio.get_running_loop()
+        try:
+            sampler.start()
+            await _measure_lag(self.lag_interval, loop.time() + seconds, lags)
+            groups, tasks = task_dump()
+        finally:
+            # join и запись файла — в пуле, чтобы не держать цикл событий
+            await loop.run_in_executor(None, sampler.stop)
+            self.running = False
+
+        path = await loop.run_in_executor(None, self._write, started, seconds, sampler, lags, tasks)
+        return path, self._summary(seconds, sampler, loop_thread, lags, groups)
+
+    def _write(self, started, seconds, sampler, lags, tasks) -> str:
+        os.makedirs(self.out_dir, exist_ok=True)
+        path = os.path.join(self.out_dir, time.strftime("profile-%Y%m%d-%H%M%S.txt", time.localtime(started)))
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"# {seconds:.0f} с, {sampler.samples} сэмплов раз в {self.interval * 1000:.0f} мс\n")
+            f.write(f"# задержка цикла, мс: {', '.join(f'{lag * 1000:.1f}' for lag in lags)}\n")
+            f.write(f"# задачи asyncio ({len(tasks)}):\n")
+            for line in tasks:
+                f.write(f"#   {line}\n")
+            for stack, count in sampler.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+    def _summary(self, seconds, sampler, loop_thread, lags, groups) -> str:
+        # Время «на себе» и «всего» — только по потоку цикла событий
+        own, total = Counter(), Counter()
+        loop_samples = 0
+        for stack, count in sampler.stacks.items():
+            frames = stack.split(";")
+            if frames[0] != loop_thread or len(frames) < 2:
+                continue
+            loop_samples += count
+            own[frames[-1]] += count
+            for name in set(frames[1:]):
+                total[name] += count
+        idle = sum(n for name, n in own.items() if name.endswith(":select"))
+
+        def share(n):
+            return f"{n / loop_samples:.0%}" if loop_samples else "—"
+
+        lines = [
+            f"🔬 Профиль за {seconds:.0f} с: {sampler.samples} сэмплов, цикл событий простаивал {share(idle)}",
+            f"Задержка цикла: p50 {_percentile(lags, 0.5) * 1000:.1f} мс, "
+            f"p95 {_percentile(lags, 0.95) * 1000:.1f} мс, макс {max(lags, default=0) * 1000:.1f} мс",
+            "",
+            "Собственное время:",
+        ]
+        lines += [f"  {share(n)} {name}" for name, n in own.most_common(12)]
+        lines += ["", "С учётом вызовов (код бота):"]
+        repo = {f for f in os.listdir(ROOT) if f.endswith(".py")}
+        lines += [f"  {share(n)} {name}" for name, n in total.most_common() if name.split(":")[0] in repo][:10]
+        lines += ["", f"Задачи asyncio: {sum(groups.values())}"]
+        lines += [f"  {n} × {name}" for name, n in groups.most_common(8)]
+        return "\n".join(lines)
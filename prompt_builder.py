@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from tokens import count_message_tokens
+
+
+# --- Сборка промпта со стабильным префиксом ---
+# OpenAI кэширует одинаковое начало промпта, поэтому порядок всегда один:
+#   1) статические системные блоки — одинаковы для всех и всегда;
+#   2) резюме прошлых разговоров — меняется редко;
+#   3) история — от хода к ходу только дописывается в конец;
+#   4) найденные разделы справочников и условные блоки (шаблон, варианты) —
+#      зависят от запроса, поэтому в самом конце;
+#   5) сообщение пользователя.
+# Системные сообщения и их токены готовятся один раз при запуске.
+class PromptBuilder:
+    def __init__(self, static_blocks: list, conditional_blocks: dict):
+        self.static_messages = [{"role": "system", "content": text} for text in static_blocks]
+        self.static_tokens = sum(count_message_tokens(text) for text in static_blocks)
+        self.conditional_messages = {
+            name: {"role": "system", "content": text} for name, text in conditional_blocks.items()
+        }
+        self.conditional_tokens = {
+            name: count_message_tokens(text) for name, text in conditional_blocks.items()
+        }
+
+    def system_tokens(self, conditional_names) -> int:
+        return self.static_tokens + sum(self.conditional_tokens[name] for name in conditional_names)
+
+    def build(self, history: list, user_text: str, conditional_names=(), summary_message=None,
+              context_messages=()) -> list:
+        return [
+            *self.static_messages,
+            *((summary_message,) if summary_message else ()),
+            *history,
+            *context_messages,
+            *(self.conditional_messages[name] for name in conditional_names),
+            {"role": "user", "content": user_text},
+        ]
+
+
+# --- Сколько промпта провайдер взял из кэша (response.usage) ---
+class PromptCacheStats:
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.last_ratio = 0.0
+
+    def record(self, usage):
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+        prompt = usage.prompt_tokens or 0
+        self.requests += 1
+        self.prompt_tokens += prompt
+        self.cached_tokens += cached
+        self.last_ratio = cached / prompt if prompt else 0.0
+
+    @property
+    def ratio(self) -> float:
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
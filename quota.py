@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import datetime
+from dataclasses import dataclass
+from typing import Optional
+from user_cache import UserRecord, parse_ts
+
+FREE_MESSAGES = 10
+
+
+# --- Снимок лимитов пользователя после учёта сообщения ---
+@dataclass(frozen=True, slots=True)
+class UserLimits:
+    user_id: int
+    allowed: bool                 # можно ли отвечать (подписка или остались бесплатные)
+    subscribed: bool
+    memory_window_open: bool      # подписка активна или закончилась не больше 14 дней назад
+    subscription_end: Optional[datetime.datetime]
+    free_messages: int
+    daily_messages: int           # уже с учётом текущего сообщения
+    voice_minutes_today: float
+    last_voice_reset: Optional[datetime.datetime]
+
+
+# 1) Создаём пользователя или обновляем last_message_time и сбрасываем дневной счётчик раз в сутки
+UPSERT_USER = """
+INSERT INTO users (user_id, first_message_time, last_message_time, free_messages,
+                   subscription_end, last_voice_reset, daily_messages, last_daily_reset)
+VALUES (:user_id, :now, :now, :free, NULL, :now, 0, :now)
+ON CONFLICT(user_id) DO UPDATE SET
+    last_message_time = :now,
+    daily_messages = CASE
+        WHEN last_daily_reset IS NULL OR julianday(:now) - julianday(last_daily_reset) >= 1 THEN 0
+        ELSE daily_messages END,
+    last_daily_reset = CASE
+        WHEN last_daily_reset IS NULL OR julianday(:now) - julianday(last_daily_reset) >= 1 THEN :now
+        ELSE last_daily_reset END
+RETURNING subscription_end, free_messages, daily_messages, last_daily_reset, voice_minutes_today, last_voice_reset
+"""
+
+# 2) Если сообщение разрешено — списываем бесплатное (без подписки) и считаем дневное
+CHARGE_MESSAGE = """
+UPDATE users SET
+    free_messages = free_messages - :charge_free,
+    daily_messages = daily_messages + 1
+WHERE user_id = :user_id
+RETURNING free_messages, daily_messages
+"""
+
+
+# Тот же учёт для пользователя из кэша: решение принимаем по кэшу, в базу — одна запись
+# без чтения. Счётчики меняем относительно, чтобы не затереть правки извне.
+TOUCH_CACHED_USER = """
+UPDATE users SET
+    last_message_time = :now,
+    daily_messages = CASE WHEN :reset THEN :charged ELSE daily_messages + :charged END,
+    last_daily_reset = CASE WHEN :reset THEN :now ELSE last_daily_reset END,
+    free_messages = free_messages - :charge_free
+WHERE user_id = :user_id
+"""
+
+
+def _daily_reset_due(last_reset, now):
+    return last_reset is None or (now - last_reset).total_seconds() >= 86400
+
+
+def _snapshot(rec: UserRecord, allowed: bool, now) -> UserLimits:
+    return UserLimits(
+        user_id=rec.user_id,
+        allowed=allowed,
+        subscribed=rec.subscribed(now),
+        memory_window_open=rec.memory_window_open(now),
+        subscription_end=rec.subscription_end,
+        free_messages=rec.free_messages,
+        daily_messages=rec.daily_messages,
+        voice_minutes_today=rec.voice_minutes_today,
+        last_voice_reset=rec.last_voice_reset,
+    )
+
+
+def _register_cached(conn, rec: UserRecord, now) -> Optional[UserLimits]:
+    reset = _daily_reset_due(rec.last_daily_reset, now)
+    subscribed = rec.subscribed(now)
+    allowed = subscribed or rec.free_messages > 0
+    charge_free = 1 if allowed and not subscribed else 0
+    charged = 1 if allowed else 0
+    with conn:
+        updated = conn.execute(TOUCH_CACHED_USER, {
+            "user_id": rec.user_id, "now": now, "reset": reset,
+            "charged": charged, "charge_free": charge_free,
+        }).rowcount
+    if not updated:
+        return None  # пользователя уже нет в базе — пойдём полным путём
+    if reset:
+        rec.daily_messages = 0
+        rec.last_daily_reset = now
+    rec.daily_messages += charged
+    rec.free_messages -= charge_free
+    return _snapshot(rec, allowed, now)
+
+
+# --- Учёт входящего сообщения: одна транзакция, один commit ---
+# Оба запроса выполняются подряд без await между ними, а первый же UPSERT берёт
+# блокировку записи, так что параллельные сообщения одного пользователя не теряют счётчики.
+# С кэшем (вызывать на потоке SQLite) горячий пользователь обходится без чтений.
+def register_message(conn, user_id, now=None, cache=None) -> UserLimits:
+    now = now or datetime.datetime.now()
+    if cache is not None:
+        rec = cache.get(user_id)
+        if rec is not None:
+            limits = _register_cached(conn, rec, now)
+            if limits is not None:
+                return limits
+            cache.invalidate(user_id)
+    with conn:
+        sub_end, free, daily, daily_reset, voice_minutes, voice_reset = conn.execute(
+            UPSERT_USER, {"user_id": user_id, "now": now, "free": FREE_MESSAGES}
+        ).fetchone()
+        sub_end = parse_ts(sub_end)
+        subscribed = sub_end is not None and now <= sub_end
+        allowed = subscribed or (free is not None and free > 0)
+        if allowed:
+            free, daily = conn.execute(
+                CHARGE_MESSAGE, {"user_id": user_id, "charge_free": 0 if subscribed else 1}
+            ).fetchone()
+    rec = UserRecord(user_id, free, sub_end, daily, daily_reset, voice_minutes, voice_reset)
+    if cache is not None:
+        cache.put(rec)
+    return _snapshot(rec, allowed, now)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import OrderedDict
+
+TIER_SUBSCRIBER = "subscriber"
+TIER_FREE = "free"
+TIER_SOFT_LIMIT = "soft_limit"  # перевалил за мягкий дневной лимит
+
+
+# --- Ведро токенов: rate токенов в секунду, не больше capacity про запас ---
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Сколько секунд ждать до n токенов (0 — можно сейчас)
+    def wait_time(self, n: float = 1.0) -> float:
+        self._refill(time.monotonic())
+        if self.tokens >= n:
+            return 0.0
+        return (n - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def try_take(self, n: float = 1.0) -> float:
+        wait = self.wait_time(n)
+        if wait == 0.0:
+            self.tokens -= n
+        return wait
+
+
+# --- Лимиты по пользователям с учётом тарифа ---
+# tiers: {тариф: (запросов в минуту, запас)}. Тариф пользователя запоминаем после
+# учёта сообщения (set_tier), а проверяем до него — так отклонённое сообщение
+# не списывает бесплатный лимит. Давно молчавшие пользователи вытесняются:
+# их ведро всё равно было бы полным.
+class RateLimiter:
+    def __init__(self, tiers: dict, default_tier: str = TIER_FREE, max_users: int = 50000):
+        self.tiers = tiers
+        self.default_tier = default_tier
+        self.max_users = max_users
+        self._buckets = OrderedDict()  # user_id -> (tier, TokenBucket)
+        self.throttled = 0
+
+    def _bucket(self, user_id, tier):
+        entry = self._buckets.get(user_id)
+        if entry is None or entry[0] != tier:
+            per_minute, burst = self.tiers[tier]
+            bucket = TokenBucket(per_minute / 60.0, burst)
+            if entry is not None:
+                bucket.tokens = min(burst, entry[1].tokens)
+            entry = (tier, bucket)
+            self._buckets[user_id] = entry
+        self._buckets.move_to_end(user_id)
+        if len(self._buckets) > self.max_users:
+            self._buckets.popitem(last=False)
+        return entry[1]
+
+    def acquire(self, user_id) -> float:
+        entry = self._buckets.get(user_id)
+        tier = entry[0] if entry else self.default_tier
+        wait = self._bucket(user_id, tier).try_take()
+        if wait:
+            self.throttled += 1
+        return wait
+
+    def set_tier(self, user_id, tier):
+        self._bucket(user_id, tier)
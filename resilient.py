@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import random
+import time
+from collections import deque
+from openai import APIConnectionError, InternalServerError, RateLimitError
+
+# Ошибки, после которых есть смысл повторить запрос (сеть, 429, 5xx, наш таймаут)
+RETRYABLE = (APIConnectionError, RateLimitError, InternalServerError, asyncio.TimeoutError)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class AllModelsUnavailable(Exception):
+    pass
+
+
+# --- Автомат отключения модели (circuit breaker) ---
+# После failure_threshold ошибок подряд модель «открывается» на cooldown секунд:
+# запросы идут сразу в запасную модель. Потом один пробный запрос (half-open):
+# успех — модель снова в работе, ошибка — ещё cooldown.
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self._probe = False
+
+    def allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = HALF_OPEN
+            self._probe = False
+        if self.state == HALF_OPEN and not self._probe:
+            self._probe = True
+            return True
+        return False
+
+    # Пробный запрос отменили, не дождавшись ответа — пусть пробует следующий
+    def release_probe(self):
+        self._probe = False
+
+    def record_success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self._probe = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                self.opens += 1
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self._probe = False
+
+
+# Скользящее окно длительностей успешных запросов для порога хеджирования
+class LatencyWindow:
+    def __init__(self, size: int = 200):
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def quantile(self, q: float):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# --- Устойчивый вызов chat.completions.create ---
+# Один вызов create() укладывается в deadline секунд вместе со всеми повторами.
+# Повторы — только на временных ошибках, с паузой «full jitter» (случайная от 0
+# до backoff * 2^попытка). Перед каждой попыткой модель выбирается заново по
+# цепочке fallbacks (gpt-4o-mini → gpt-3.5-turbo): если автомат основной модели
+# открыт, запрос сразу идёт в запасную.
+#
+# Хеджирование: если попытка идёт дольше p95 для таких же запросов, параллельно
+# запускается дубль; берётся первый ответ, второй отменяется (у стрима —
+# закрывается). Для стрима время ответа — это время до начала потока, для
+# обычного запроса — вся генерация, поэтому окна раздельные: по модели, стриму
+# и max_tokens (_window_key). Фоновые вызовы передают hedge=False — ради них
+# платить за дубль незачем.
+#
+# quota — ведро квоты OpenAI из LLMScheduler. Первая попытка уже оплачена
+# слотом планировщика, а каждый повтор (в том числе в запасную модель) и каждый
+# дубль берут из ведра ещё по токену: повтор ждёт токен, дубль без свободного
+# токена не запускается. После 429 дубли не запускаются hedge_pause секунд.
+class ResilientCompletions:
+    def __init__(self, client, fallbacks: dict = None, deadline: float = 60.0, retries: int = 2,
+                 backoff: float = 0.5, hedge: bool = True, hedge_quantile: float = 0.95,
+                 hedge_min_samples: int = 20, max_hedges: int = 4,
+                 breaker_failures: int = 5, breaker_cooldown: float = 30.0,
+                 quota=None, hedge_pause: float = 30.0):
+        self.client = client
+        self.quota = quota
+        self.hedge_pause = hedge_pause
+        self._hedge_paused_until = 0.0
+        self.fallbacks = fallbacks or {}
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.max_hedges = max_hedges
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        self.breakers = {}
+        self.latency = {}
+        self._hedges_in_flight = 0
+        self.calls = 0
+        self.retried = 0
+        self.timeouts = 0
+        self.failed = 0
+        self.fallback_calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.quota_waited = 0.0
+
+    def breaker(self, model) -> CircuitBreaker:
+        if model not in self.breakers:
+            self.breakers[model] = CircuitBreaker(self.breaker_failures, self.breaker_cooldown)
+        return self.breakers[model]
+
+    def _chain(self, model):
+        chain = [model]
+        while chain[-1] in self.fallbacks and self.fallbacks[chain[-1]] not in chain:
+            chain.append(self.fallbacks[chain[-1]])
+        return chain
+
+    def _pick_model(self, model):
+        for candidate in self._chain(model):
+            if self.breaker(candidate).allow():
+                return candidate
+        return None
+
+    @staticmethod
+    def _window_key(model, kwargs):
+        return model, bool(kwargs.get("stream")), kwargs.get("max_tokens")
+
+    def _hedge_delay(self, key):
+        window = self.latency.get(key)
+        if not self.hedge or window is None or len(window.samples) < self.hedge_min_samples:
+            return None
+        if time.monotonic() < self._hedge_paused_until:
+            return None
+        return window.quantile(self.hedge_quantile)
+
+    async def create(self, model: str, hedge: bool = True, **kwargs):
+        result, _ = await self.create_with_model(model, hedge=hedge, **kwargs)
+        return result
+
+    # То же, что create(), плюс модель, которая на самом деле ответила
+    # (после переключения автомата это может быть запасная)
+    async def create_with_model(self, model: str, hedge: bool = True, **kwargs):
+        self.calls += 1
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            chosen = self._pick_model(model)
+            if chosen is None:
+                self.failed += 1
+                raise AllModelsUnavailable(f"все модели временно недоступны: {self._chain(model)}")
+            if chosen != model:
+                self.fallback_calls += 1
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                return await asyncio.wait_for(self._attempt(chosen, kwargs, hedge), remaining), chosen
+            except RETRYABLE as e:
+                self.breaker(chosen).record_failure()
+                if isinstance(e, asyncio.TimeoutError):
+                    self.timeouts += 1
+                if isinstance(e, RateLimitError):
+                    self._hedge_paused_until = time.monotonic() + self.hedge_pause
+                pause = random.uniform(0, self.backoff * 2 ** attempt)
+                if self.quota is not None:
+                    # Повтор — это ещё один запрос к OpenAI: ждём токен квоты, а если
+                    # он будет только после дедлайна — сдаёмся сразу
+                    pause = max(pause, self.quota.wait_time())
+                # Если автомат этой модели только что открылся, повторы уже пойдут
+                # в запасную модель — им даём свои попытки
+                budget = self.retries * (len(self._chain(model)) if self.breaker(chosen).state == OPEN else 1)
+                if attempt >= budget or time.monotonic() + pause >= deadline:
+                    self.failed += 1
+                    raise
+                attempt += 1
+                self.retried += 1
+                print(f"[LLM RETRY] {chosen}: {type(e).__name__}, попытка {attempt + 1} через {pause:.2f} с")
+                await asyncio.sleep(pause)
+                if not await self._take_quota(deadline):
+                    self.failed += 1
+                    raise
+            except asyncio.CancelledError:
+                self.breaker(chosen).release_probe()
+                raise
+            except Exception:
+                # Ошибки запроса (400 и т.п.) повторять бесполезно; модель при этом ответила,
+                # так что для автомата это не сбой
+                self.breaker(chosen).record_success()
+                self.failed += 1
+                raise
+
+    async def _take_quota(self, deadline) -> bool:
+        if self.quota is None:
+            return True
+        while True:
+            wait = self.quota.try_take()
+            if wait == 0.0:
+                return True
+            if time.monotonic() + wait >= deadline:
+                return False
+            self.quota_waited += wait
+            await asyncio.sleep(wait)
+
+    async def _timed_call(self, model, kwargs):
+        started = time.monotonic()
+        result = await self.client.chat.completions.create(model=model, **kwargs)
+        key = self._window_key(model, kwargs)
+        self.latency.setdefault(key, LatencyWindow()).add(time.monotonic() - started)
+        return result
+
+    async def _attempt(self, model, kwargs, hedge: bool = True):
+        primary = asyncio.ensure_future(self._timed_call(model, kwargs))
+        tasks = [primary]
+        winner = None
+        try:
+            delay = self._hedge_delay(self._window_key(model, kwargs)) if hedge else None
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and self._hedges_in_flight < self.max_hedges and self._hedge_allowed():
+                    self.hedges += 1
+                    self._hedges_in_flight += 1
+                    hedge = asyncio.ensure_future(self._timed_call(model, kwargs))
+                    hedge.add_done_callback(self._hedge_done)
+                    tasks.append(hedge)
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        break
+                    error = task.exception()
+                if winner is not None:
+                    break
+            if winner is None:
+                raise error
+            if winner is not primary:
+                self.hedge_wins += 1
+            self.breaker(model).record_success()
+            return winner.result()
+        finally:
+            for task in tasks:
+                if task is not winner:
+                    _drop(task)
+
+    # Дубль — лишний запрос: только если в ведре квоты есть свободный токен
+    def _hedge_allowed(self) -> bool:
+        return self.quota is None or self.quota.try_take() == 0.0
+
+    def _hedge_done(self, task):
+        self._hedges_in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "retries": self.retried,
+            "timeouts": self.timeouts,
+            "failed": self.failed,
+            "fallback_calls": self.fallback_calls,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "quota_waited_s": round(self.quota_waited, 1),
+            "breakers": {
+                model: {"state": b.state, "failures": b.failures, "opens": b.opens}
+                for model, b in self.breakers.items()
+            },
+            "p95_ms": {
+                f"{model}{' stream' if stream else ''} ≤{max_tokens}": round((w.quantile(0.95) or 0) * 1000)
+                for (model, stream, max_tokens), w in self.latency.items()
+            },
+        }
+
+
+# Проигравший запрос отменяем, а если он уже успел вернуть стрим — закрываем его
+def _drop(task):
+    if task.done():
+        _close_result(task)
+    else:
+        task.cancel()
+        task.add_done_callback(_close_result)
+
+
+def _close_result(task):
+    if task.cancelled() or task.exception() is not None:
+        return
+    close = getattr(task.result(), "close", None)
+    if close is not None:
+        asyncio.ensure_future(close())
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import numpy as np
+from kb_retrieval import WORD_RE, STEM_LEN
+from storage import get_meta, set_meta
+from user_cache import MEMORY_GRACE
+
+
+# --- Эмбеддер по умолчанию: хэширование слов, работает без сети ---
+# Любой другой эмбеддер подходит, если у него есть dim и embed(texts) -> (n, dim)
+# с нормированными строками (например, обёртка над API эмбеддингов).
+class HashingEmbedder:
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    def _bucket(self, term: str):
+        h = int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+        return h % self.dim, 1.0 if (h >> 63) & 1 else -1.0
+
+    def embed(self, texts):
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in WORD_RE.findall(text.lower()):
+                if len(word) <= 2:
+                    continue
+                # основа слова + его буквенные триграммы с меньшим весом:
+                # триграммы сглаживают падежи («мама» / «мамой»)
+                idx, sign = self._bucket(word[:STEM_LEN])
+                out[i, idx] += sign
+                for j in range(len(word) - 2):
+                    idx, sign = self._bucket("#" + word[j:j + 3])
+                    out[i, idx] += sign * 0.5
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return out / norms
+
+
+BACKFILL_KEY = "vectors_backfill_id"
+
+
+# --- Долговременная память: векторы прошлых сообщений пользователя ---
+# Векторы хранятся в message_vectors компактно (float16, BLOB) рядом с id сообщения.
+# Все методы с conn вызываются на потоке SQLite.
+class SemanticMemory:
+    def __init__(self, embedder=None, min_chars: int = 20):
+        self.embedder = embedder or HashingEmbedder()
+        self.min_chars = min_chars
+
+    # rows: (message_id, user_id, role, content) только что записанных сообщений
+    def index(self, conn, rows):
+        rows = [r for r in rows if r[2] == "user" and len(r[3]) >= self.min_chars]
+        if not rows:
+            return 0
+        vectors = self.embedder.embed([r[3] for r in rows]).astype(np.float16)
+        conn.executemany(
+            "INSERT OR REPLACE INTO message_vectors (message_id, user_id, vec) VALUES (?, ?, ?)",
+            [(r[0], r[1], v.tobytes()) for r, v in zip(rows, vectors)]
+        )
+        return len(rows)
+
+    # Дозаполнение векторов для истории, записанной до появления памяти. Докуда
+    # дошли, хранится в meta (BACKFILL_KEY), так что каждое сообщение
+    # просматривается один раз за всё время, а не при каждом старте. Окно памяти
+    # проверяется прямо в SQL через JOIN с users — кэш пользователей не трогаем.
+    # Одна пачка = одна транзакция вместе с новой отметкой; 0 пачек — (None, 0).
+    def backfill_batch(self, conn, now, batch_size: int):
+        after_id = get_meta(conn, BACKFILL_KEY, 0)
+        upto = conn.execute(
+            "SELECT MAX(id) FROM (SELECT id FROM messages WHERE id > ? ORDER BY id LIMIT ?)",
+            (after_id, batch_size)
+        ).fetchone()[0]
+        if upto is None:
+            return None, 0
+        rows = conn.execute(
+            "SELECT m.id, m.user_id, m.role, m.content FROM messages m "
+            "JOIN users u ON u.user_id = m.user_id "
+            "LEFT JOIN message_vectors v ON v.message_id = m.id "
+            "WHERE m.id > ? AND m.id <= ? AND m.role = 'user' AND v.message_id IS NULL "
+            "AND u.subscription_end IS NOT NULL AND julianday(u.subscription_end) >= julianday(?)",
+            (after_id, upto, now - MEMORY_GRACE)
+        ).fetchall()
+        with conn:
+            indexed = self.index(conn, rows)
+            set_meta(conn, BACKFILL_KEY, upto)
+        return upto, indexed
+
+    # Окно памяти открылось заново (новая подписка): его сообщения, пропущенные
+    # и on_flush, и backfill_batch, индексируем сразу по индексу (user_id, id)
+    def index_user(self, conn, user_id):
+        rows = conn.execute(
+            "SELECT m.id, m.user_id, m.role, m.content FROM messages m "
+            "LEFT JOIN message_vectors v ON v.message_id = m.id "
+            "WHERE m.user_id = ? AND m.role = 'user' AND v.message_id IS NULL",
+            (user_id,)
+        ).fetchall()
+        return self.index(conn, rows)
+
+    def recall(self, conn, user_id, text: str, top_k: int = 3, min_similarity: float = 0.3, exclude=()):
+        rows = conn.execute(
+            "SELECT message_id, vec FROM message_vectors WHERE user_id=?", (user_id,)
+        ).fetchall()
+        size = self.embedder.dim * 2
+        rows = [r for r in rows if len(r[1]) == size]  # векторы от другого эмбеддера пропускаем
+        if not rows or not text:
+            return []
+        matrix = np.frombuffer(b"".join(r[1] for r in rows), dtype=np.float16).reshape(len(rows), -1)
+        query = self.embedder.embed([text])[0].astype(np.float16)
+        scores = matrix.astype(np.float32) @ query.astype(np.float32)
+        order = np.argsort(-scores)
+        ids = [rows[i][0] for i in order[:top_k * 3] if scores[i] >= min_similarity]
+        if not ids:
+            return []
+        placeholders = ",".join("?" * len(ids))
+        contents = dict(conn.execute(
+            f"SELECT id, content FROM messages WHERE id IN ({placeholders})", ids
+        ).fetchall())
+        # В порядке похожести, без того, что и так уже есть в истории промпта
+        snippets = [contents[i] for i in ids if i in contents and contents[i] not in exclude]
+        return snippets[:top_k]
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+import argparse
+import asyncio
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import zlib
+import httpx
+from dotenv import load_dotenv
+from storage import migrate
+from webhook import WebhookServer, SECRET_HEADER
+
+# --- Шардирование по пользователям ---
+# Все апдейты и все данные одного пользователя живут в одном воркере и в одном
+# файле базы: порядок его сообщений сохраняется, кэши и очередь LLM — локальные.
+
+
+def shard_for(user_id, shards: int) -> int:
+    # crc32 стабилен между процессами и запусками (в отличие от hash())
+    return zlib.crc32(str(user_id).encode()) % shards if shards > 1 else 0
+
+
+def shard_path(db_path: str, index: int) -> str:
+    root, ext = os.path.splitext(db_path)
+    return f"{root}.shard{index}{ext or '.db'}"
+
+
+# user_id из сырого JSON апдейта: message.from, callback_query.from, poll_answer.user …
+# Апдейты без пользователя (например, посты каналов) — по чату.
+def update_user_id(data: dict):
+    for key, value in data.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if isinstance(user, dict) and "id" in user:
+            return user["id"]
+        chat = value.get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return 0
+
+
+# --- Фронт: принимает вебхук и раздаёт апдейты воркерам ---
+# На каждый шард — своя очередь и один отправитель, так что апдейты одного
+# пользователя доходят до воркера в том порядке, в каком пришли. Telegram
+# получает 200 сразу после постановки в очередь.
+class ShardRouter:
+    def __init__(self, worker_urls: list, secret: str = None, max_attempts: int = 5):
+        self.worker_urls = worker_urls
+        self.secret = secret
+        self.max_attempts = max_attempts
+        self.queues = [asyncio.Queue() for _ in worker_urls]
+        self.forwarded = [0] * len(worker_urls)
+        self.dropped = 0
+        self._client = None
+        self._tasks = []
+
+    async def route(self, data: dict):
+        await self.queues[shard_for(update_user_id(data), len(self.worker_urls))].put(data)
+
+    def start(self):
+        self._client = httpx.AsyncClient(timeout=10)
+        self._tasks = [asyncio.create_task(self._sender(i)) for i in range(len(self.worker_urls))]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._client is not None:
+            await self._client.aclose()
+
+    async def _sender(self, index):
+        queue = self.queues[index]
+        headers = {SECRET_HEADER: self.secret} if self.secret else {}
+        while True:
+            data = await queue.get()
+            for attempt in range(self.max_attempts):
+                try:
+                    response = await self._client.post(self.worker_urls[index], json=data, headers=headers)
+                    if response.status_code == 200:
+                        self.forwarded[index] += 1
+                        break
+                    print(f"[SHARD {index}] Воркер ответил {response.status_code}")
+                except httpx.HTTPError as e:
+                    print(f"[SHARD {index}] Воркер недоступен: {e}")
+                # воркер мог ещё не подняться или перезапускается — ждём, не теряя порядок
+                await asyncio.sleep(min(2 ** attempt, 10))
+            else:
+                self.dropped += 1
+                print(f"[SHARD {index}] Апдейт {data.get('update_id')} не доставлен")
+
+
+# --- Разбиение существующей базы на шарды ---
+# Копируются все таблицы с колонкой user_id, id сообщений сохраняются (на них
+# ссылаются резюме и векторы). Исходная база не меняется.
+def split_database(db_path: str, shards: int, out_paths=None):
+    out_paths = out_paths or [shard_path(db_path, i) for i in range(shards)]
+    for path in out_paths:
+        if os.path.exists(path):
+            raise FileExistsError(f"{path} уже существует")
+    counts = []
+    for index, path in enumerate(out_paths):
+        conn = sqlite3.connect(path)
+        migrate(conn)
+        conn.create_function("shard_for", 2, shard_for, deterministic=True)
+        conn.execute("ATTACH DATABASE ? AS src", (db_path,))
+        copied = {}
+        with conn:
+            tables = [r[0] for r in conn.execute(
+                "SELECT name FROM src.sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'"
+            )]
+            for table in tables:
+                src_cols = [r[1] for r in conn.execute(f"PRAGMA src.table_info({table})")]
+                dst_cols = {r[1] for r in conn.execute(f"PRAGMA main.table_info({table})")}
+                if "user_id" not in src_cols or not dst_cols:
+                    continue
+                cols = ", ".join(c for c in src_cols if c in dst_cols)
+                copied[table] = conn.execute(
+                    f"INSERT INTO main.{table} ({cols}) SELECT {cols} FROM src.{table} "
+                    f"WHERE shard_for(user_id, ?) = ?", (shards, index)
+                ).rowcount
+        conn.execute("DETACH DATABASE src")
+        conn.close()
+        counts.append(copied)
+        print(f"[SHARD {index}] {path}: " + ", ".join(f"{t}={n}" for t, n in copied.items()))
+    return counts
+
+
+# --- Запуск: фронт + N воркеров main.py ---
+# Воркеры — обычный бот в режиме вебхука на локальных портах, каждый со своей
+# базой. Квота OpenAI и общий лимит Telegram на бота делятся между ними поровну. Вебхук в Telegram регистрирует фронт.
+def worker_env(index: int, shards: int, base_port: int, db_path: str):
+    env = dict(os.environ)
+    env.update({
+        "BOT_MODE": "webhook",
+        "WEBHOOK_LISTEN": "127.0.0.1",
+        "WEBHOOK_PORT": str(base_port + index),
+        "DB_PATH": shard_path(db_path, index),
+        "OPENAI_RPM": str(float(os.getenv("OPENAI_RPM", 500)) / shards),
+        # лимит Telegram — на токен бота, а токен у всех воркеров один
+        "TG_GLOBAL_PER_SEC": str(float(os.getenv("TG_GLOBAL_PER_SEC", 30)) / shards),
+    })
+    env.pop("WEBHOOK_URL", None)
+    # у каждого воркера свой порт /metrics: METRICS_PORT + номер шарда
+    metrics_port = int(os.getenv("METRICS_PORT", 9100))
+    if metrics_port:
+        env["METRICS_PORT"] = str(metrics_port + index)
+    return env
+
+
+async def run_front(shards: int, base_port: int, db_path: str):
+    from telegram import Bot, Update
+
+    secret = os.getenv("WEBHOOK_SECRET")
+    if not secret:
+        raise ValueError("❌ Для шардированного режима нужен WEBHOOK_SECRET!")
+    path = os.getenv("WEBHOOK_PATH", "/telegram")
+    main_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    workers = [
+        subprocess.Popen([sys.executable, main_py], env=worker_env(i, shards, base_port, db_path))
+        for i in range(shards)
+    ]
+    router = ShardRouter([f"http://127.0.0.1:{base_port + i}{path}" for i in range(shards)], secret)
+    server = WebhookServer(
+        router.route, os.getenv("WEBHOOK_LISTEN", "0.0.0.0"), int(os.getenv("WEBHOOK_PORT", 8443)), path, secret
+    )
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        router.start()
+        await server.start()
+        url = os.getenv("WEBHOOK_URL")
+        if url:
+            async with Bot(os.getenv("TELEGRAM_TOKEN")) as bot:
+                await bot.set_webhook(url.rstrip("/") + path, secret_token=secret, allowed_updates=Update.ALL_TYPES)
+        print(f"✅ Фронт запущен: {shards} воркеров, порты {base_port}–{base_port + shards - 1}")
+        await stop.wait()
+    finally:
+        await server.stop()
+        await router.stop()
+        for proc in workers:
+            proc.send_signal(signal.SIGTERM)
+        for proc in workers:
+            proc.wait()
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Шардирование бота по пользователям")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_split = sub.add_parser("split", help="разбить базу на шарды")
+    p_split.add_argument("db", nargs="?", default=os.getenv("DB_PATH", "bot_memory.db"))
+    p_split.add_argument("--shards", type=int, required=True)
+    p_run = sub.add_parser("run", help="запустить фронт и воркеры")
+    p_run.add_argument("--shards", type=int, default=int(os.getenv("SHARD_COUNT", 2)))
+    p_run.add_argument("--base-port", type=int, default=int(os.getenv("SHARD_BASE_PORT", 9000)))
+    p_run.add_argument("--db", default=os.getenv("DB_PATH", "bot_memory.db"))
+    args = parser.parse_args()
+    if args.command == "split":
+        split_database(args.db, args.shards)
+    else:
+        asyncio.run(run_front(args.shards, args.base_port, args.db))
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import functools
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+# Настройки SQLite под много параллельных чтений и частые мелкие записи
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",      # в WAL этого достаточно: при сбое питания теряется максимум последний коммит
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",       # ~20 МБ страничного кэша
+    "PRAGMA mmap_size=134217728",     # 128 МБ
+)
+
+
+def add_column_if_missing(conn, table, column, decl):
+    columns = [r[1] for r in conn.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+# --- Миграции схемы ---
+# Номер применённой миграции хранится в PRAGMA user_version. Новые миграции
+# только дописываются в конец списка, старые не меняются. Все шаги идемпотентны:
+# базы, которые уже успели получить часть изменений без миграций, проходят их спокойно.
+def _migration_1_base(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        first_message_time TIMESTAMP,
+        last_message_time TIMESTAMP,
+        free_messages INTEGER DEFAULT 10,
+        subscription_end TIMESTAMP,
+        voice_minutes_today INTEGER DEFAULT 0,
+        last_voice_reset TIMESTAMP,
+        daily_messages INTEGER DEFAULT 0,
+        last_daily_reset TIMESTAMP
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        role TEXT,
+        content TEXT,
+        timestamp TIMESTAMP
+    )
+    ''')
+
+
+def _migration_2_history_window(conn):
+    # Кэш числа токенов рядом с сообщением + индекс для чтения истории с конца
+    add_column_if_missing(conn, "messages", "token_count", "INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages (user_id, id)")
+
+
+def _migration_3_summaries(conn):
+    # Резюме старой части переписки (одна строка на пользователя)
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS summaries (
+        user_id INTEGER PRIMARY KEY,
+        summary TEXT,
+        last_message_id INTEGER,
+        token_count INTEGER,
+        updated_at TIMESTAMP
+    )
+    ''')
+
+
+def _migration_4_message_vectors(conn):
+    # Векторы сообщений для долговременной памяти (float16 в BLOB)
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS message_vectors (
+        message_id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        vec BLOB
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_message_vectors_user_id ON message_vectors (user_id)")
+
+
+def _migration_5_usage_daily(conn):
+    # Расход токенов и времени: одна строка на (день, пользователь, модель, режим)
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS usage_daily (
+        day TEXT,
+        user_id INTEGER,
+        model TEXT,
+        mode TEXT,
+        calls INTEGER DEFAULT 0,
+        prompt_tokens INTEGER DEFAULT 0,
+        completion_tokens INTEGER DEFAULT 0,
+        cached_tokens INTEGER DEFAULT 0,
+        wall_ms INTEGER DEFAULT 0,
+        PRIMARY KEY (day, user_id, model, mode)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_usage_daily_user_id ON usage_daily (user_id, day)")
+
+
+def _migration_6_meta(conn):
+    # Служебные значения «ключ — значение» (например, докуда дошли фоновые задачи)
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value
+    )
+    ''')
+
+
+MIGRATIONS = [
+    _migration_1_base,
+    _migration_2_history_window,
+    _migration_3_summaries,
+    _migration_4_message_vectors,
+    _migration_5_usage_daily,
+    _migration_6_meta,
+]
+
+
+def migrate(conn):
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    for version, step in enumerate(MIGRATIONS, start=1):
+        if version <= current:
+            continue
+        with conn:
+            step(conn)
+            conn.execute(f"PRAGMA user_version={version}")
+        print(f"[DB] Миграция {version} ({step.__name__}) применена")
+    return len(MIGRATIONS)
+
+
+def get_meta(conn, key, default=None):
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return default if row is None else row[0]
+
+
+def set_meta(conn, key, value):
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+
+# --- Хранилище: одно соединение, все запросы на отдельном потоке ---
+# Цикл событий никогда не ждёт диск: run() отдаёт функцию в поток SQLite и
+# ждёт результат асинхронно. Функции получают conn первым аргументом и
+# берут собственный курсор на каждый запрос (conn.execute).
+class Storage:
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self.conn = self._executor.submit(self._connect).result()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        migrate(conn)
+        return conn
+
+    async def run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(fn, self.conn, *args, **kwargs)
+        )
+
+    # Для кода вне цикла событий (старт, утилиты)
+    def run_sync(self, fn, *args, **kwargs):
+        return self._executor.submit(fn, self.conn, *args, **kwargs).result()
+
+    def close(self):
+        self._executor.submit(self.conn.close).result()
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+from telegram.constants import ChatAction
+from telegram.error import BadRequest, RetryAfter
+from outbound import TELEGRAM_TEXT_LIMIT, split_message
+
+PLACEHOLDER_TEXT = "…"
+CURSOR = " ▍"
+INTERIM_LIMIT = TELEGRAM_TEXT_LIMIT - len(CURSOR)  # промежуточный текст вместе с курсором влезает в лимит
+TYPING_REFRESH = 4.0  # статус «печатает» гаснет примерно через 5 секунд
+
+
+# --- Постепенная отправка ответа: плейсхолдер + редактирование по мере генерации ---
+# Telegram не любит частые правки одного сообщения, поэтому правим не чаще edit_interval
+# и только если текст заметно вырос. Всё, что не влезло в 4096 символов, уходит
+# отдельными сообщениями в finish() — с делением по абзацам. Как только текст
+# перерос одно сообщение, промежуточные правки прекращаются (только «печатает»).
+# Промежуточные правки не ждут паузу после RetryAfter (rate_limit_args=0), а пропускаются.
+class TelegramStreamWriter:
+    def __init__(self, bot, chat_id: int, edit_interval: float = 1.0, min_delta: int = 20):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.edit_interval = edit_interval
+        self.min_delta = min_delta
+        self.message_id = None
+        self._shown = ""
+        self._last_edit = 0.0
+        self._last_typing = 0.0
+        self._blocked_until = 0.0
+
+    async def start(self, reply_to_message_id=None):
+        await self._typing()
+        msg = await self.bot.send_message(
+            self.chat_id, PLACEHOLDER_TEXT, reply_to_message_id=reply_to_message_id
+        )
+        self.message_id = msg.message_id
+
+    async def _typing(self):
+        self._last_typing = time.monotonic()
+        try:
+            await self.bot.send_chat_action(self.chat_id, ChatAction.TYPING)
+        except RetryAfter:
+            pass
+
+    async def _edit(self, text: str, interim: bool = False) -> bool:
+        try:
+            await self.bot.edit_message_text(
+                text, chat_id=self.chat_id, message_id=self.message_id,
+                **({"rate_limit_args": 0} if interim else {})
+            )
+        except RetryAfter as e:
+            self._blocked_until = time.monotonic() + float(e.retry_after)
+            return False
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+        self._shown = text
+        self._last_edit = time.monotonic()
+        return True
+
+    async def push(self, text: str):
+        now = time.monotonic()
+        if not text.strip() or len(text) > INTERIM_LIMIT:
+            if now - self._last_typing >= TYPING_REFRESH:
+                await self._typing()
+            return
+        if now < self._blocked_until or now - self._last_edit < self.edit_interval:
+            return
+        if len(text) - len(self._shown) < self.min_delta:
+            return
+        await self._edit(text + CURSOR, interim=True)
+
+    async def finish(self, text: str):
+        parts = split_message(text) if text else [""]
+        wait = self._blocked_until - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        while not await self._edit(parts[0] or PLACEHOLDER_TEXT):
+            await asyncio.sleep(max(0.0, self._blocked_until - time.monotonic()))
+        for part in parts[1:]:
+            await self.bot.send_message(self.chat_id, part)
+
+
+# --- Читаем стрим OpenAI и параллельно обновляем сообщение в чате ---
+# Возвращает (текст, usage); usage приходит последним чанком без choices,
+# если в запросе stream_options={"include_usage": True}.
+# Если idle_timeout секунд не приходит ни одного кусочка — asyncio.TimeoutError.
+async def stream_to_chat(stream, writer: TelegramStreamWriter, idle_timeout: float = None):
+    chunks = []
+    usage = None
+    it = stream.__aiter__()
+    while True:
+        try:
+            chunk = await asyncio.wait_for(it.__anext__(), idle_timeout)
+        except StopAsyncIteration:
+            break
+        except asyncio.TimeoutError:
+            await stream.close()
+            raise
+        if getattr(chunk, "usage", None) is not None:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            chunks.append(delta)
+            await writer.push("".join(chunks))
+    text = "".join(chunks)
+    await writer.finish(text)
+    return text, usage
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from telegram import ReplyKeyboardMarkup, Update
-from telegram.ext import Application, MessageHandler, ContextTypes, filters
+from telegram.ext import ContextTypes
 from telegram.constants import ParseMode
 import random
 
@@ -224,7 +224,8 @@ async def handle_slezy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         reply_markup=TEARS_FLOW_KB
     )
 
-def setup_tears_block(app: Application) -> None:
-    # Обработчики для кнопок «Слёзы» и «Ещё про слёзы»
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex(r"^Слёзы$"), handle_slezy))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex(r"^Ещё про слёзы$"), handle_slezy))
+# Кнопки «Слёзы» и «Ещё про слёзы» (подключаются в MenuRouter)
+TEARS_MENU = {
+    "Слёзы": handle_slezy,
+    "Ещё про слёзы": handle_slezy,
+}
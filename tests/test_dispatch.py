@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+from types import SimpleNamespace
+from telegram.ext import ApplicationBuilder, ExtBot, TypeHandler
+from dispatch import per_user_builder
+
+
+class OfflineBot(ExtBot):
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def _update(user_id, n):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id), n=n)
+
+
+async def _run(updates, slots, work):
+    app = per_user_builder(ApplicationBuilder().bot(OfflineBot("0:test")), slots).build()
+    started = time.perf_counter()
+    done = {}
+
+    async def handle(update, context):
+        await asyncio.sleep(work)
+        done[(update.effective_user.id, update.n)] = time.perf_counter() - started
+
+    app.add_handler(TypeHandler(SimpleNamespace, handle))
+    await app.initialize()
+    await app.start()
+    try:
+        for update in updates:
+            await app.update_queue.put(update)
+        while len(done) < len(updates):
+            await asyncio.sleep(0.01)
+    finally:
+        await app.stop()
+        await app.shutdown()
+    return done
+
+
+# Очередь одного пользователя не занимает общие слоты: второй пользователь
+# получает ответ сразу, а не после того, как разойдётся чужая очередь
+def test_backlog_of_one_user_does_not_delay_another():
+    work = 0.2
+    updates = [_update(1, i) for i in range(6)] + [_update(2, 0)]
+    done = asyncio.run(_run(updates, slots=4, work=work))
+    assert done[(2, 0)] < work * 2
+    # апдейты первого — по очереди и в исходном порядке
+    first = [done[(1, i)] for i in range(6)]
+    assert first == sorted(first)
+    assert first[-1] >= work * 6 * 0.9
+
+
+def test_global_limit_still_applies_across_users():
+    work = 0.2
+    done = asyncio.run(_run([_update(uid, 0) for uid in range(1, 5)], slots=2, work=work))
+    assert max(done.values()) >= work * 2 * 0.9
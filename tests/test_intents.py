@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import random
+from intents import DEFAULT_KEYWORDS, IntentMatcher, load_matcher
+
+# Буквы, на которых легко ошибиться: заглавные, ё/е, символы, которые при
+# IGNORECASE совпадают с кириллицей, но .lower() в неё не переводятся
+TRICKY = "ВЕРНУТЬБЫВШЁёᲀᲁᲂᲃᲄᲅᲆᲇİẞ?!., \n"
+
+
+def naive_groups(keywords, text):
+    lowered = text.lower()
+    return {group for group, words in keywords.items() if any(w.lower() in lowered for w in words)}
+
+
+def matcher_groups(matcher, text):
+    mask = matcher.scan(text)
+    return {group for group in matcher.groups if matcher.has(mask, group)}
+
+
+def random_text(rng, words):
+    parts = []
+    for _ in range(rng.randint(0, 8)):
+        roll = rng.random()
+        if roll < 0.4:
+            word = rng.choice(words)
+            # кусок ключа, весь ключ или ключ в другом регистре
+            if rng.random() < 0.3:
+                word = word[:rng.randint(1, len(word))]
+            parts.append(word.upper() if rng.random() < 0.3 else word)
+        elif roll < 0.7:
+            parts.append("".join(rng.choice(TRICKY) for _ in range(rng.randint(1, 6))))
+        else:
+            parts.append("".join(chr(rng.randint(0x20, 0x4FF)) for _ in range(rng.randint(1, 6))))
+    return rng.choice(["", " ", "\n"]).join(parts)
+
+
+# Один проход по trie даёт те же группы, что и проверки `k in text.lower()` по спискам
+def test_matches_naive_substring_checks():
+    rng = random.Random(12)
+    matcher = load_matcher()
+    words = [w for ws in DEFAULT_KEYWORDS.values() for w in ws]
+    for _ in range(20000):
+        text = random_text(rng, words)
+        assert matcher_groups(matcher, text) == naive_groups(DEFAULT_KEYWORDS, text), text
+
+
+def test_casefold_only_characters_do_not_crash():
+    matcher = load_matcher()
+    for text in ("ᲀернуть", "ᲂᲀᲁ", "İ", "ẞ"):
+        assert matcher_groups(matcher, text) == naive_groups(DEFAULT_KEYWORDS, text)
+    assert not matcher.reformulating([{"role": "user", "content": "ᲀернуть"}])
+
+
+def test_nested_keywords_keep_their_groups():
+    matcher = IntentMatcher({"a": ["распиши"], "b": ["пиш"]})
+    assert matcher_groups(matcher, "Распиши") == {"a", "b"}
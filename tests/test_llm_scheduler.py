@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from llm_scheduler import LLMScheduler
+
+
+class CountingScheduler(LLMScheduler):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.grants = 0
+        self.timers_armed = 0
+
+    def _grant(self):
+        self.grants += 1
+        armed = self._timer
+        super()._grant()
+        if self._timer is not None and self._timer is not armed:
+            self.timers_armed += 1
+
+
+# При исчерпанной квоте взведён не больше одного таймера: число вызовов _grant
+# растёт линейно с числом запросов, а не с квадратом длины очереди
+def test_empty_quota_keeps_a_single_timer():
+    requests = 60
+    scheduler = CountingScheduler(max_concurrency=8, max_queue=requests, rate_per_minute=2400)
+
+    async def call():
+        await asyncio.sleep(0.001)
+
+    async def run():
+        await asyncio.gather(*(scheduler.submit(call) for _ in range(requests)))
+
+    asyncio.run(run())
+    assert scheduler.completed == requests
+    # 40 токенов в запасе, остальные 20 ждут таймер — по одному за раз
+    assert scheduler.timers_armed <= requests
+    assert scheduler.grants <= requests * 4
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import pytest
+from message_log import MessageLog
+from semantic_memory import SemanticMemory
+from storage import Storage
+
+
+@pytest.fixture
+def storage(tmp_path):
+    db = Storage(str(tmp_path / "bot.db"))
+    yield db
+    db.close()
+
+
+def _count(conn, table):
+    return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+# Ошибка индексации не откатывает запись сообщений и не копит буфер
+def test_on_flush_error_keeps_messages(storage):
+    def broken(conn, rows):
+        raise RuntimeError("embedder down")
+
+    log = MessageLog(storage, on_flush=broken)
+
+    async def run():
+        log.append(1, "user", "первое")
+        log.append(1, "assistant", "второе")
+        assert await log.flush() == 2
+        log.append(1, "user", "третье")
+        assert await log.flush() == 1
+
+    asyncio.run(run())
+    assert log.pending == 0
+    assert storage.run_sync(_count, "messages") == 3
+
+
+def test_on_flush_gets_committed_ids(storage):
+    memory = SemanticMemory()
+    log = MessageLog(storage, on_flush=memory.index)
+
+    async def run():
+        log.append(7, "user", "Мне тревожно перед экзаменом завтра")
+        log.append(7, "assistant", "Понимаю")
+        await log.flush()
+
+    asyncio.run(run())
+    rows = storage.run_sync(lambda conn: conn.execute(
+        "SELECT v.message_id, m.role FROM message_vectors v JOIN messages m ON m.id = v.message_id"
+    ).fetchall())
+    assert [role for _, role in rows] == ["user"]
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+import pytest
+from types import SimpleNamespace
+from rate_limit import TokenBucket
+from resilient import ResilientCompletions
+
+
+class FlakyCompletions:
+    def __init__(self, fails=0, delay=0.0):
+        self.calls = 0
+        self.fails = fails
+        self.delay = delay
+
+    async def create(self, model, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.calls <= self.fails:
+            raise asyncio.TimeoutError()
+        return "ok"
+
+
+def _resilient(backend, quota, **kwargs):
+    return ResilientCompletions(SimpleNamespace(chat=SimpleNamespace(completions=backend)),
+                                backoff=0.01, quota=quota, **kwargs)
+
+
+def _empty_bucket(rate):
+    bucket = TokenBucket(rate, 1.0)
+    bucket.try_take()  # первый токен уже взял слот планировщика
+    return bucket
+
+
+def test_retry_waits_for_quota_token():
+    backend = FlakyCompletions(fails=1)
+    rc = _resilient(backend, _empty_bucket(5.0), deadline=5)
+    started = time.monotonic()
+    assert asyncio.run(rc.create("m")) == "ok"
+    assert backend.calls == 2
+    assert time.monotonic() - started >= 0.15  # токен появляется через 0.2 с
+
+
+def test_retry_gives_up_when_quota_is_beyond_deadline():
+    backend = FlakyCompletions(fails=1)
+    rc = _resilient(backend, _empty_bucket(0.1), deadline=1)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(rc.create("m"))
+    assert backend.calls == 1
+
+
+def test_no_hedge_without_free_quota():
+    backend = FlakyCompletions(delay=0.02)
+    rc = _resilient(backend, _empty_bucket(0.0001), hedge_min_samples=1)
+
+    async def run():
+        await rc.create("m")
+        backend.delay = 0.1
+        await rc.create("m")
+
+    asyncio.run(run())
+    assert rc.hedges == 0
+    assert backend.calls == 2
+
+
+def test_create_with_model_reports_fallback_model():
+    backend = FlakyCompletions()
+    rc = _resilient(backend, None, fallbacks={"primary": "backup"}, breaker_failures=1)
+    rc.breaker("primary").record_failure()  # автомат основной модели открыт
+    result, served = asyncio.run(rc.create_with_model("primary"))
+    assert (result, served) == ("ok", "backup")
+    assert rc.fallback_calls == 1
+
+
+# Быстрые «время до начала стрима» не делают p95 для обычных запросов
+def test_stream_latency_does_not_trigger_hedges_for_plain_calls():
+    backend = FlakyCompletions(delay=0.01)
+    rc = _resilient(backend, None, hedge_min_samples=3)
+
+    async def run():
+        for _ in range(5):
+            await rc.create("m", stream=True, max_tokens=500)
+        backend.delay = 0.1
+        await rc.create("m", max_tokens=400)
+
+    asyncio.run(run())
+    assert rc.hedges == 0
+
+
+def test_hedge_false_disables_duplicates():
+    def hedges_with(hedge):
+        backend = FlakyCompletions(delay=0.01)
+        rc = _resilient(backend, None, hedge_min_samples=3)
+
+        async def run():
+            for _ in range(5):
+                await rc.create("m", max_tokens=400)
+            backend.delay = 0.1
+            await rc.create("m", max_tokens=400, hedge=hedge)
+
+        asyncio.run(run())
+        return rc.hedges
+
+    assert hedges_with(True) == 1
+    assert hedges_with(False) == 0
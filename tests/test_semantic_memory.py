@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import datetime
+import pytest
+from semantic_memory import BACKFILL_KEY, SemanticMemory
+from storage import Storage, get_meta
+
+NOW = datetime.datetime(2026, 10, 1, 12, 0)
+TEXT = "сообщение достаточно длинное для индексации"
+
+
+@pytest.fixture
+def storage(tmp_path):
+    db = Storage(str(tmp_path / "bot.db"))
+    yield db
+    db.close()
+
+
+def _seed(conn, users, messages_per_user):
+    with conn:
+        conn.executemany("INSERT INTO users (user_id, subscription_end) VALUES (?, ?)", users)
+        conn.executemany(
+            "INSERT INTO messages (user_id, role, content) VALUES (?, ?, ?)",
+            [(user_id, role, TEXT) for _ in range(messages_per_user)
+             for user_id, _ in users for role in ("user", "assistant")]
+        )
+
+
+def _indexed_users(conn):
+    return {r[0]: r[1] for r in conn.execute("SELECT user_id, COUNT(*) FROM message_vectors GROUP BY user_id")}
+
+
+def _backfill(conn, memory, batch_size):
+    total = batches = 0
+    while True:
+        last_id, indexed = memory.backfill_batch(conn, NOW, batch_size)
+        if last_id is None:
+            return total, batches
+        total += indexed
+        batches += 1
+
+
+def test_backfill_indexes_open_windows_and_resumes(storage):
+    memory = SemanticMemory()
+    users = [
+        (1, NOW + datetime.timedelta(days=30)),  # подписка идёт
+        (2, NOW - datetime.timedelta(days=3)),   # закончилась, но окно ещё открыто
+        (3, NOW - datetime.timedelta(days=30)),  # окно закрыто
+        (4, None),                               # подписки не было
+    ]
+    storage.run_sync(_seed, users, 5)
+
+    assert storage.run_sync(_backfill, memory, 7) == (10, 6)
+    assert storage.run_sync(_indexed_users) == {1: 5, 2: 5}
+    assert storage.run_sync(get_meta, BACKFILL_KEY) == 40
+
+    # Повторный старт не пересматривает уже пройденные сообщения
+    assert storage.run_sync(_backfill, memory, 7) == (0, 0)
+    storage.run_sync(_seed, [(5, NOW + datetime.timedelta(days=1))], 2)
+    assert storage.run_sync(_backfill, memory, 7) == (2, 1)
+
+
+def test_index_user_catches_up_reopened_window(storage):
+    memory = SemanticMemory()
+    storage.run_sync(_seed, [(3, NOW - datetime.timedelta(days=30))], 4)
+    storage.run_sync(_backfill, memory, 100)
+    assert storage.run_sync(_indexed_users) == {}
+
+    assert storage.run_sync(memory.index_user, 3) == 4
+    assert storage.run_sync(memory.index_user, 3) == 0
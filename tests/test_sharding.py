@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+from sharding import shard_path, worker_env
+
+
+# Лимиты на один токен бота и одну квоту OpenAI делятся между воркерами
+def test_worker_env_splits_shared_limits(monkeypatch):
+    monkeypatch.setenv("OPENAI_RPM", "600")
+    monkeypatch.setenv("TG_GLOBAL_PER_SEC", "30")
+    envs = [worker_env(i, 3, 9000, "bot.db") for i in range(3)]
+    assert sum(float(e["TG_GLOBAL_PER_SEC"]) for e in envs) == 30
+    assert sum(float(e["OPENAI_RPM"]) for e in envs) == 600
+    assert [e["DB_PATH"] for e in envs] == [shard_path("bot.db", i) for i in range(3)]
+    assert len({e["WEBHOOK_PORT"] for e in envs}) == 3
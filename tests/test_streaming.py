@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import itertools
+from types import SimpleNamespace
+from telegram.error import BadRequest
+from outbound import TELEGRAM_TEXT_LIMIT
+from streaming import TelegramStreamWriter, stream_to_chat
+
+
+# Бот, который, как Bot API, отказывает в текстах длиннее 4096 символов
+class StrictBot:
+    def __init__(self):
+        self.ids = itertools.count(1)
+        self.messages = {}
+
+    def _check(self, text):
+        if len(text) > TELEGRAM_TEXT_LIMIT:
+            raise BadRequest("Message is too long")
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self._check(text)
+        message_id = next(self.ids)
+        self.messages[message_id] = text
+        return SimpleNamespace(message_id=message_id)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self._check(text)
+        self.messages[message_id] = text
+
+    async def send_chat_action(self, chat_id, action, **kwargs):
+        pass
+
+
+class FakeStream:
+    def __init__(self, pieces):
+        self.pieces = pieces
+
+    async def _gen(self):
+        for piece in self.pieces:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))], usage=None)
+
+    def __aiter__(self):
+        return self._gen()
+
+    async def close(self):
+        pass
+
+
+def test_long_stream_fits_telegram_limit():
+    # ~5400 символов кириллицей, по 30 символов за чанк — правки идут вплоть до границы
+    pieces = ["Понимаю тебя, это непросто. " + ("\n\n" if i % 20 == 19 else "") for i in range(190)]
+    bot = StrictBot()
+
+    async def run():
+        writer = TelegramStreamWriter(bot, chat_id=1, edit_interval=0, min_delta=1)
+        await writer.start()
+        return await stream_to_chat(FakeStream(pieces), writer)
+
+    text, _ = asyncio.run(run())
+    assert len(text) > TELEGRAM_TEXT_LIMIT
+    assert len(bot.messages) >= 2
+    assert all(len(m) <= TELEGRAM_TEXT_LIMIT for m in bot.messages.values())
+    assert "".join(bot.messages.values()).replace("\n", "").replace(" ", "") == text.replace("\n", "").replace(" ", "")
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# --- Подсчёт токенов ---
+# Если установлен tiktoken — считаем точно, иначе грубая оценка:
+# кириллица выходит примерно в 2.5 символа на токен, латиница — около 4.
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("o200k_base")
+except Exception:
+    _ENCODING = None
+
+MESSAGE_OVERHEAD = 4  # служебные токены на каждое сообщение в chat-формате
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text))
+    cyrillic = sum(1 for ch in text if "Ѐ" <= ch <= "ӿ")
+    return int(cyrillic / 2.5 + (len(text) - cyrillic) / 4) + 1
+
+
+def count_message_tokens(content: str) -> int:
+    return count_tokens(content) + MESSAGE_OVERHEAD
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import datetime
+
+# Цены за 1M токенов, USD: (вход, вход из кэша, выход). Для моделей не из списка
+# стоимость не считается — токены всё равно учитываются.
+PRICES = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-3.5-turbo": (0.50, 0.50, 1.50),
+}
+
+UPSERT_USAGE = """
+INSERT INTO usage_daily (day, user_id, model, mode, calls, prompt_tokens, completion_tokens, cached_tokens, wall_ms)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(day, user_id, model, mode) DO UPDATE SET
+    calls = calls + excluded.calls,
+    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+    completion_tokens = completion_tokens + excluded.completion_tokens,
+    cached_tokens = cached_tokens + excluded.cached_tokens,
+    wall_ms = wall_ms + excluded.wall_ms
+"""
+
+
+def cost(model, prompt_tokens, completion_tokens, cached_tokens):
+    price = PRICES.get(model)
+    if price is None:
+        return None
+    return ((prompt_tokens - cached_tokens) * price[0] + cached_tokens * price[1]
+            + completion_tokens * price[2]) / 1_000_000
+
+
+# --- Учёт токенов и времени ответов ---
+# record() только складывает числа в словарь в памяти по ключу
+# (день, пользователь, модель, режим). Раз в flush_interval секунд накопленное
+# уходит в usage_daily одним executemany с UPSERT — одна строка на ключ за день,
+# сколько бы ни было вызовов. Пока сброс идёт, новые записи копятся в новом словаре.
+class UsageLedger:
+    def __init__(self, storage, flush_interval: float = 30):
+        self.storage = storage
+        self.flush_interval = flush_interval
+        self._pending = {}  # (day, user_id, model, mode) -> [calls, prompt, completion, cached, wall_ms]
+        self._task = None
+        self.flushes = 0
+
+    def record(self, user_id, model, mode, usage, seconds: float):
+        key = (datetime.date.today().isoformat(), user_id, model, mode)
+        row = self._pending.get(key)
+        if row is None:
+            row = self._pending[key] = [0, 0, 0, 0, 0]
+        row[0] += 1
+        row[4] += int(seconds * 1000)
+        if usage is not None:
+            details = getattr(usage, "prompt_tokens_details", None)
+            row[1] += usage.prompt_tokens or 0
+            row[2] += usage.completion_tokens or 0
+            row[3] += (getattr(details, "cached_tokens", 0) or 0) if details is not None else 0
+
+    async def flush(self):
+        batch, self._pending = self._pending, {}
+        if not batch:
+            return 0
+        try:
+            await self.storage.run(_write_usage, batch)
+        except Exception:
+            # вернём несохранённое обратно, чтобы не потерять при следующем сбросе
+            for key, row in batch.items():
+                current = self._pending.setdefault(key, [0, 0, 0, 0, 0])
+                for i, value in enumerate(row):
+                    current[i] += value
+            raise
+        self.flushes += 1
+        return len(batch)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"[USAGE ERROR] {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+
+def _write_usage(conn, batch):
+    with conn:
+        conn.executemany(UPSERT_USAGE, [key + tuple(row) for key, row in batch.items()])
+
+
+# При удалении пользователя его расход переносится на user_id 0:
+# итоги по дням и моделям сохраняются, привязка к человеку — нет.
+def anonymize_usage(conn, user_ids):
+    placeholders = ",".join("?" * len(user_ids))
+    conn.execute(f"""
+        INSERT INTO usage_daily (day, user_id, model, mode, calls, prompt_tokens, completion_tokens, cached_tokens, wall_ms)
+        SELECT day, 0, model, mode, SUM(calls), SUM(prompt_tokens), SUM(completion_tokens), SUM(cached_tokens), SUM(wall_ms)
+        FROM usage_daily WHERE user_id IN ({placeholders})
+        GROUP BY day, model, mode
+        ON CONFLICT(day, user_id, model, mode) DO UPDATE SET
+            calls = calls + excluded.calls,
+            prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+            completion_tokens = completion_tokens + excluded.completion_tokens,
+            cached_tokens = cached_tokens + excluded.cached_tokens,
+            wall_ms = wall_ms + excluded.wall_ms
+    """, user_ids)
+    conn.execute(f"DELETE FROM usage_daily WHERE user_id IN ({placeholders})", user_ids)
+
+
+# --- Запросы для админа ---
+# Все по диапазону дней: первичный ключ начинается с day, так что это
+# поиск по индексу, а не полный проход по таблице.
+
+def usage_by_model(conn, since: str):
+    return conn.execute(
+        "SELECT model, mode, SUM(calls), SUM(prompt_tokens), SUM(completion_tokens), SUM(cached_tokens), SUM(wall_ms) "
+        "FROM usage_daily WHERE day >= ? GROUP BY model, mode ORDER BY SUM(prompt_tokens + completion_tokens) DESC",
+        (since,)
+    ).fetchall()
+
+
+def top_users(conn, since: str, limit: int = 10):
+    return conn.execute(
+        "SELECT user_id, SUM(calls), SUM(prompt_tokens), SUM(completion_tokens) "
+        "FROM usage_daily WHERE day >= ? AND user_id != 0 GROUP BY user_id "
+        "ORDER BY SUM(prompt_tokens + completion_tokens) DESC LIMIT ?",
+        (since, limit)
+    ).fetchall()
+
+
+# Ответов за день на пользователя (без резюме) и токены этих дней — по ним
+# видно, сколько стоят «тяжёлые» дни и где ставить пороги понижения модели.
+def daily_user_load(conn, since: str):
+    return conn.execute(
+        "SELECT SUM(calls), SUM(prompt_tokens + completion_tokens) FROM usage_daily "
+        "WHERE day >= ? AND mode != 'summary' AND user_id != 0 GROUP BY day, user_id",
+        (since,)
+    ).fetchall()
+
+
+def threshold_report(rows, downgrade_at: int, limit: int):
+    if not rows:
+        return None
+    calls = sorted(n for n, _ in rows)
+    total_tokens = sum(t for _, t in rows) or 1
+
+    def pct(q):
+        return calls[min(len(calls) - 1, int(q * len(calls)))]
+
+    over_downgrade = [t for n, t in rows if n > downgrade_at]
+    return {
+        "user_days": len(rows),
+        "p50": pct(0.5),
+        "p90": pct(0.9),
+        "p99": pct(0.99),
+        "max": calls[-1],
+        "over_downgrade_share": len(over_downgrade) / len(rows),
+        "over_downgrade_tokens": sum(over_downgrade) / total_tokens,
+        "at_limit_share": sum(1 for n in calls if n >= limit) / len(rows),
+    }
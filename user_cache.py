@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import datetime
+import time
+from collections import OrderedDict
+
+MEMORY_GRACE = datetime.timedelta(weeks=2)  # память доступна ещё 14 дней после подписки
+
+USER_COLUMNS = (
+    "user_id, free_messages, subscription_end, daily_messages, "
+    "last_daily_reset, voice_minutes_today, last_voice_reset"
+)
+
+
+def parse_ts(value):
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.fromisoformat(value)
+
+
+# --- Запись о пользователе: разобранные даты вместо позиционного кортежа ---
+class UserRecord:
+    __slots__ = (
+        "user_id", "free_messages", "subscription_end", "memory_until",
+        "daily_messages", "last_daily_reset", "voice_minutes_today",
+        "last_voice_reset", "loaded_at",
+    )
+
+    def __init__(self, user_id, free_messages, subscription_end, daily_messages,
+                 last_daily_reset, voice_minutes_today, last_voice_reset):
+        self.user_id = user_id
+        self.free_messages = free_messages or 0
+        self.set_subscription_end(parse_ts(subscription_end))
+        self.daily_messages = daily_messages or 0
+        self.last_daily_reset = parse_ts(last_daily_reset)
+        self.voice_minutes_today = voice_minutes_today or 0
+        self.last_voice_reset = parse_ts(last_voice_reset)
+        self.loaded_at = time.monotonic()
+
+    def set_subscription_end(self, subscription_end):
+        self.subscription_end = subscription_end
+        self.memory_until = subscription_end + MEMORY_GRACE if subscription_end else None
+
+    def subscribed(self, now=None) -> bool:
+        return self.subscription_end is not None and (now or datetime.datetime.now()) <= self.subscription_end
+
+    def memory_window_open(self, now=None) -> bool:
+        return self.memory_until is not None and (now or datetime.datetime.now()) <= self.memory_until
+
+
+# --- LRU-кэш пользователей ---
+# Трогать только на потоке SQLite (внутри функций для storage.run): тогда кэш
+# меняется строго вместе с соответствующими запросами и не нуждается в блокировках.
+# ttl ограничивает, как долго мы не замечаем правки базы извне (например, оплату).
+class UserCache:
+    def __init__(self, max_size: int = 10000, ttl: float = 300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        rec = self._items.get(user_id)
+        if rec is None or time.monotonic() - rec.loaded_at > self.ttl:
+            if rec is not None:
+                del self._items[user_id]
+            self.misses += 1
+            return None
+        self._items.move_to_end(user_id)
+        self.hits += 1
+        return rec
+
+    def put(self, rec: UserRecord):
+        self._items[rec.user_id] = rec
+        self._items.move_to_end(rec.user_id)
+        if len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def invalidate(self, *user_ids):
+        for user_id in user_ids:
+            self._items.pop(user_id, None)
+
+    def __len__(self):
+        return len(self._items)
+
+
+def load_user(conn, cache: UserCache, user_id):
+    rec = cache.get(user_id)
+    if rec is None:
+        row = conn.execute(f"SELECT {USER_COLUMNS} FROM users WHERE user_id=?", (user_id,)).fetchone()
+        if row is None:
+            return None
+        rec = UserRecord(*row)
+        cache.put(rec)
+    return rec
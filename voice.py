@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import io
+from collections import OrderedDict
+
+# --- Нарезка длинных голосовых ---
+# Если установлены pydub и ffmpeg — длинная запись режется на куски, которые
+# распознаются параллельно. Без них голосовое отправляется целиком.
+try:
+    from pydub import AudioSegment
+except Exception:
+    AudioSegment = None
+
+
+def split_voice(data: bytes, chunk_seconds: float):
+    if AudioSegment is None:
+        return [data]
+    try:
+        audio = AudioSegment.from_file(io.BytesIO(data), format="ogg")
+        step = int(chunk_seconds * 1000)
+        chunks = []
+        for start in range(0, len(audio), step):
+            out = io.BytesIO()
+            audio[start:start + step].export(out, format="ogg", codec="libopus")
+            chunks.append(out.getvalue())
+        return chunks or [data]
+    except Exception as e:
+        print(f"[VOICE] Не удалось разрезать голосовое: {e}")
+        return [data]
+
+
+# --- Распознавание голосовых с кэшем по file_unique_id ---
+# file_unique_id одинаков у пересланных и повторно отправленных голосовых,
+# поэтому одна и та же запись распознаётся один раз. Одновременные запросы
+# той же записи ждут один общий результат, а не запускают распознавание заново.
+#
+# transcribe(buf, **kwargs) -> str — асинхронный вызов модели распознавания,
+# download() -> bytes — асинхронное скачивание файла (только при промахе кэша).
+class VoiceTranscriber:
+    def __init__(self, transcribe, cache_size: int = 1000, chunk_seconds: float = 60.0):
+        self.transcribe = transcribe
+        self.cache_size = cache_size
+        self.chunk_seconds = chunk_seconds
+        self._cache = OrderedDict()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def text_for(self, key, download, duration: float = 0, **kwargs) -> str:
+        text = self._cache.get(key)
+        if text is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return text
+        future = self._inflight.get(key)
+        if future is not None:
+            self.hits += 1
+            return await asyncio.shield(future)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            text = await self._recognize(await download(), duration, **kwargs)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # ошибку получат ждущие, если они есть
+            raise
+        finally:
+            del self._inflight[key]
+        future.set_result(text)
+        if text:
+            self._cache[key] = text
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return text
+
+    async def _recognize(self, data: bytes, duration: float, **kwargs) -> str:
+        if duration > self.chunk_seconds:
+            chunks = await asyncio.to_thread(split_voice, data, self.chunk_seconds)
+        else:
+            chunks = [data]
+        parts = await asyncio.gather(*(
+            self.transcribe(_named_buffer(chunk, i), **kwargs) for i, chunk in enumerate(chunks)
+        ))
+        # gather сохраняет порядок кусков
+        return " ".join(p.strip() for p in parts if p and p.strip())
+
+
+def _named_buffer(data: bytes, index: int):
+    # По имени файла API определяет формат записи
+    buf = io.BytesIO(data)
+    buf.name = f"voice_{index}.ogg"
+    return buf
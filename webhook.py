@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import argparse
+import asyncio
+import hmac
+import json
+import urllib.error
+import urllib.request
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+MAX_BODY = 1024 * 1024  # апдейты Telegram намного меньше
+REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+           405: "Method Not Allowed", 413: "Payload Too Large"}
+
+
+# --- Приём апдейтов по вебхуку ---
+# Минимальный HTTP-сервер на asyncio: Telegram шлёт POST с JSON апдейта на path
+# и заголовком X-Telegram-Bot-Api-Secret-Token. Проверяем секрет, отдаём JSON в
+# on_update и сразу отвечаем 200 — сама обработка идёт через очередь приложения.
+# Соединения keep-alive: Telegram держит их открытыми и шлёт апдейты подряд.
+class WebhookServer:
+    def __init__(self, on_update, host: str = "0.0.0.0", port: int = 8443,
+                 path: str = "/telegram", secret: str = None):
+        self.on_update = on_update
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self._server = None
+        self.received = 0
+        self.rejected = 0
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        # при port=0 система выбирает свободный порт
+        self.port = self._server.sockets[0].getsockname()[1]
+        print(f"[WEBHOOK] Слушаю http://{self.host}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                if length > MAX_BODY:
+                    await _respond(writer, 413, close=True)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                status = await self._dispatch(method, target, headers, body)
+                close = headers.get("connection", "").lower() == "close"
+                await _respond(writer, status, close=close)
+                if close:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, target, headers, body):
+        if target.split("?", 1)[0] != self.path:
+            return 404
+        if method != "POST":
+            return 405
+        if self.secret and not hmac.compare_digest(headers.get(SECRET_HEADER, ""), self.secret):
+            self.rejected += 1
+            return 403
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400
+        if not isinstance(data, dict) or "update_id" not in data:
+            return 400
+        self.received += 1
+        await self.on_update(data)
+        return 200
+
+
+async def _respond(writer, status, close=False):
+    writer.write(
+        f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Length: 0\r\n"
+        f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n".encode("latin-1")
+    )
+    await writer.drain()
+
+
+# --- Локальная проверка без Telegram ---
+# python webhook.py updates.json --url http://127.0.0.1:8443/telegram --secret ...
+# Файл — один апдейт (JSON-объект), список апдейтов или JSON Lines.
+def load_updates(path):
+    with open(path, encoding="utf-8") as f:
+        text = f.read().strip()
+    if text.startswith("["):
+        return json.loads(text)
+    if text.startswith("{") and "\n{" not in text:
+        return [json.loads(text)]
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def replay(updates, url, secret=None):
+    statuses = []
+    for update in updates:
+        request = urllib.request.Request(
+            url, data=json.dumps(update).encode("utf-8"), method="POST",
+            headers={"Content-Type": "application/json", **({"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {})}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                statuses.append(response.status)
+        except urllib.error.HTTPError as e:
+            statuses.append(e.code)
+    return statuses
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Отправить записанные апдейты на локальный вебхук")
+    parser.add_argument("file")
+    parser.add_argument("--url", default="http://127.0.0.1:8443/telegram")
+    parser.add_argument("--secret")
+    args = parser.parse_args()
+    updates = load_updates(args.file)
+    for update, status in zip(updates, replay(updates, args.url, args.secret)):
+        print(f"update_id={update.get('update_id')}: {status}")